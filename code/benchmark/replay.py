@@ -0,0 +1,556 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+# Local replay benchmark of the whole pipeline: Veeva -> AVAIPoller -> S3/SQS -> AVAIQueuePoller -> AI services
+# -> DynamoDB -> stream -> AVAIPopulateES -> Elasticsearch, without a vault or an AWS account.
+#
+# S3, SQS and DynamoDB (including the tags table stream) are provided by moto, Veeva and Elasticsearch by
+# in-process stubs mounted on the handlers' requests sessions, and the AI services by canned responses with
+# a configurable latency. A synthetic vault of --documents documents is built from the sample files in inputs/.
+#
+# usage: python code/benchmark/replay.py --documents 1000 [--ai-latency-ms 50] [--json results.json]
+#
+# the report also includes the time to import each handler module in a fresh interpreter, the cold start cost
+# paid before the first invocation.
+#
+# requires boto3, requests, requests_aws4auth and moto. The numbers include the overhead of moto and the stubs,
+# which run in the same process, so they are meant for comparing changes rather than predicting AWS throughput.
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore.client
+import requests
+from requests.adapters import BaseAdapter
+from urllib3.response import HTTPResponse
+from moto import mock_aws
+
+sourceDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+# the shared modules of the Lambda layer, found under /opt when deployed.
+libDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+inputsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'inputs')
+
+region = 'us-east-1'
+bucketName = 'avai-bench'
+queueName = 'avai-bench.fifo'
+tagsTable = 'avai-bench-tags'
+checkpointTable = 'avai-bench-checkpoint'
+pendingJobsTable = 'avai-bench-pending-jobs'
+resultCacheTable = 'avai-bench-result-cache'
+veevaDomain = 'bench'
+esDomain = 'bench-es.local'
+
+formats = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.pdf': 'application/pdf', '.mp3': 'audio/mp3'}
+
+# text returned by the Textract and Transcribe stubs and searched by the Comprehend Medical stub.
+sampleText = ('Patient was prescribed aspirin 81 mg daily for the prevention of blood clots. '
+              'Reported side effects include nausea and stomach pain. Discontinue ibuprofen before surgery. '
+              'History of hypertension and type 2 diabetes, currently treated with metformin 500 mg twice daily.')
+entityTerms = [('aspirin', 'MEDICATION', 'GENERIC_NAME'), ('ibuprofen', 'MEDICATION', 'GENERIC_NAME'),
+               ('metformin', 'MEDICATION', 'GENERIC_NAME'), ('nausea', 'MEDICAL_CONDITION', 'DX_NAME'),
+               ('stomach pain', 'MEDICAL_CONDITION', 'DX_NAME'), ('blood clots', 'MEDICAL_CONDITION', 'DX_NAME'),
+               ('hypertension', 'MEDICAL_CONDITION', 'DX_NAME'), ('type 2 diabetes', 'MEDICAL_CONDITION', 'DX_NAME'),
+               ('surgery', 'TEST_TREATMENT_PROCEDURE', 'PROCEDURE_NAME')]
+
+
+class Stats:
+    # call counts and durations, shared by the stubs and the timed handler functions.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.durations = collections.defaultdict(list)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.calls[name] += amount
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+
+    def timed(self, module, name, stage):
+        # replace module.name with a wrapper recording the duration of every call under stage.
+        function = getattr(module, name)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        setattr(module, name, wrapper)
+
+stats = Stats()
+
+def count_api_calls():
+    # count every botocore call by service and operation, including the ones served by moto.
+    makeApiCall = botocore.client.BaseClient._make_api_call
+    def wrapper(self, operationName, apiParams):
+        stats.count('{0}.{1}'.format(self.meta.service_model.service_name, operationName))
+        return makeApiCall(self, operationName, apiParams)
+    botocore.client.BaseClient._make_api_call = wrapper
+
+
+def make_response(request, status, body, contentType='application/json'):
+    response = requests.Response()
+    response.status_code = status
+    response.url = request.url
+    response.request = request
+    response.headers['Content-Type'] = contentType
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+    response.headers['Content-Length'] = str(len(body))
+    response.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False, status=status)
+    return response
+
+class VeevaStub(BaseAdapter):
+    # the Veeva Vault REST API calls made by AVAIPoller, serving a synthetic vault of documents.
+    def __init__(self, documents, contents, pageSize, latency):
+        super().__init__()
+        self.documents = documents
+        self.contents = contents
+        self.pageSize = pageSize
+        self.latency = latency
+
+    def page(self, request, offset):
+        data = self.documents[offset:offset + self.pageSize]
+        details = {'pagesize': self.pageSize, 'pageoffset': offset, 'size': len(data), 'total': len(self.documents)}
+        if offset + self.pageSize < len(self.documents):
+            details['next_page'] = '/api/v20.1/query/bench?pagesize={0}&pageoffset={1}'.format(self.pageSize, offset + self.pageSize)
+        return make_response(request, 200, {'responseStatus': 'SUCCESS', 'responseDetails': details, 'data': data})
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        url = urllib.parse.urlparse(request.url)
+        path = url.path[len('/api/v20.1/'):]
+        if path == 'auth' or path == 'keep-alive':
+            stats.count('veeva.' + path)
+            return make_response(request, 200, {'responseStatus': 'SUCCESS', 'sessionId': 'bench-session'})
+        if path == 'query':
+            stats.count('veeva.query')
+            return self.page(request, 0)
+        if path.startswith('query/'):
+            stats.count('veeva.query')
+            return self.page(request, int(urllib.parse.parse_qs(url.query)['pageoffset'][0]))
+        if path.startswith('objects/documents/'):
+            stats.count('veeva.file')
+            documentId = path.split('/')[2]
+            content = self.contents[documentId]
+            stats.count('veeva.bytes', len(content))
+            return make_response(request, 200, content, 'application/octet-stream;charset=UTF-8')
+        return make_response(request, 404, {'responseStatus': 'FAILURE'})
+
+    def close(self):
+        pass
+
+class ElasticsearchStub(BaseAdapter):
+    # the Elasticsearch calls made by AVAIPopulateES, accepting every document.
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.indices = set()
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        path = urllib.parse.urlparse(request.url).path
+        name = path.strip('/').split('/')[0]
+        if path == '/_bulk':
+            body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+            stats.count('es._bulk')
+            stats.count('es.bytes', len(body))
+            items = []
+            lines = body.splitlines()
+            position = 0
+            while position < len(lines):
+                (operation, meta), = json.loads(lines[position]).items()
+                position += 1 if operation == 'delete' else 2
+                stats.count('es.' + operation)
+                items.append({operation: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 200 if operation == 'delete' else 201}})
+            return make_response(request, 200, {'took': 1, 'errors': False, 'items': items})
+        stats.count('es.' + request.method + ' ' + (path.split('/')[-1] if path.split('/')[-1].startswith('_') else 'index'))
+        if request.method == 'GET':
+            if name in self.indices:
+                return make_response(request, 200, {name: {'mappings': {'properties': {}}}})
+            return make_response(request, 404, {'error': 'index_not_found_exception'})
+        if request.method == 'PUT' and '/' not in path.strip('/'):
+            self.indices.add(name)
+        return make_response(request, 200, {'acknowledged': True})
+
+    def close(self):
+        pass
+
+
+class Rekognition:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def call(self, operation, Image):
+        stats.count('rekognition.' + operation)
+        if 'Bytes' in Image:
+            stats.count('rekognition.image_bytes', len(Image['Bytes']))
+        time.sleep(self.latency)
+
+    def detect_labels(self, Image, **kwargs):
+        self.call('DetectLabels', Image)
+        name = Image.get('S3Object', {}).get('Name', '')
+        content = Image['Bytes'] if 'Bytes' in Image else name.encode('utf-8')
+        labels = [{'Name': 'Label{0}'.format(i), 'Confidence': 60 + i * 1.7} for i in range(20)]
+        if 'Nurse' in name or zlib.crc32(content) % 3 == 0:
+            labels.append({'Name': 'Person', 'Confidence': 98.3})
+        return {'Labels': labels}
+
+    def detect_faces(self, Image, **kwargs):
+        self.call('DetectFaces', Image)
+        face = {'BoundingBox': {}, 'Landmarks': [], 'Pose': {}, 'Quality': {}, 'Confidence': 99.2,
+                'AgeRange': {'Low': 25, 'High': 35}, 'Smile': {'Value': True, 'Confidence': 93.1},
+                'Eyeglasses': {'Value': False, 'Confidence': 97.4},
+                'Emotions': [{'Type': 'HAPPY', 'Confidence': 88.8}, {'Type': 'CALM', 'Confidence': 9.1}]}
+        return {'FaceDetails': [face]}
+
+    def detect_text(self, Image, **kwargs):
+        self.call('DetectText', Image)
+        return {'TextDetections': [{'Type': 'LINE', 'DetectedText': 'Line {0}'.format(i), 'Confidence': 95.5} for i in range(5)]}
+
+class Textract:
+    def __init__(self, latency, lines):
+        self.latency = latency
+        self.lines = lines
+        self.jobs = []
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs):
+        stats.count('textract.StartDocumentTextDetection')
+        time.sleep(self.latency)
+        jobId = uuid.uuid4().hex
+        self.jobs.append(jobId)
+        return {'JobId': jobId}
+
+    def get_document_text_detection(self, JobId, **kwargs):
+        stats.count('textract.GetDocumentTextDetection')
+        time.sleep(self.latency)
+        blocks = [{'BlockType': 'LINE', 'Page': 1 + i // 50, 'Text': sampleText} for i in range(self.lines)]
+        return {'JobStatus': 'SUCCEEDED', 'Blocks': blocks}
+
+class Transcribe:
+    def __init__(self, latency):
+        self.latency = latency
+        self.jobs = []
+        self.s3 = boto3.client('s3', region_name=region)
+
+    def start_transcription_job(self, TranscriptionJobName, OutputBucketName, **kwargs):
+        stats.count('transcribe.StartTranscriptionJob')
+        time.sleep(self.latency)
+        transcript = {'jobName': TranscriptionJobName, 'results': {'transcripts': [{'transcript': sampleText}]}}
+        self.s3.put_object(Bucket=OutputBucketName, Key=TranscriptionJobName + '.json', Body=json.dumps(transcript).encode('utf-8'))
+        self.jobs.append(TranscriptionJobName)
+        return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName, 'TranscriptionJobStatus': 'IN_PROGRESS'}}
+
+    def get_transcription_job(self, TranscriptionJobName):
+        stats.count('transcribe.GetTranscriptionJob')
+        time.sleep(self.latency)
+        uri = 'https://s3.amazonaws.com/{0}/{1}.json'.format(bucketName, TranscriptionJobName)
+        return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName, 'TranscriptionJobStatus': 'COMPLETED',
+                                     'Transcript': {'TranscriptFileUri': uri}}}
+
+class ComprehendMedical:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def detect_entities(self, Text):
+        stats.count('comprehendmedical.DetectEntities')
+        time.sleep(self.latency)
+        entities = []
+        lowerText = Text.lower()
+        for term, category, entityType in entityTerms:
+            start = lowerText.find(term)
+            while start != -1:
+                entities.append({'Id': len(entities), 'BeginOffset': start, 'EndOffset': start + len(term), 'Score': 0.9731,
+                                 'Text': Text[start:start + len(term)], 'Category': category, 'Type': entityType,
+                                 'Traits': [], 'Attributes': []})
+                start = lowerText.find(term, start + 1)
+        return {'Entities': entities}
+
+
+class Context:
+    # the parts of the Lambda context object the handlers use.
+    def __init__(self, timeoutSeconds):
+        self.deadline = time.monotonic() + timeoutSeconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def build_vault(count, maxFileBytes, sharedContent):
+    # documents cycle through the sample files, with a unique file name per document.
+    samples = []
+    for name in sorted(os.listdir(inputsDir)):
+        extension = os.path.splitext(name)[1].lower()
+        if extension in formats:
+            with open(os.path.join(inputsDir, name), 'rb') as f:
+                data = f.read()
+            samples.append((name.replace(' ', '_'), formats[extension], data[:maxFileBytes] if maxFileBytes else data))
+    documents = []
+    contents = {}
+    for i in range(count):
+        name, fileFormat, data = samples[i % len(samples)]
+        documentId = str(i + 1)
+        documents.append({'id': i + 1, 'format__v': fileFormat, 'filename__v': '{0:06d}_{1}'.format(i + 1, name),
+                          'major_version_number__v': 1, 'minor_version_number__v': 0,
+                          'version_modified_date__v': '2020-05-01T00:00:00.000Z', 'version_creation_date__v': '2020-05-01T00:00:00.000Z'})
+        # unless content is shared, every document gets distinct bytes so the result cache does not hide AI calls.
+        contents[documentId] = data if sharedContent else data + documentId.encode('ascii')
+    return documents, contents
+
+def create_resources():
+    dynamodb = boto3.client('dynamodb', region_name=region)
+    dynamodb.create_table(TableName=tagsTable, BillingMode='PAY_PER_REQUEST',
+                          KeySchema=[{'AttributeName': 'ROWID', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'ROWID', 'AttributeType': 'S'}, {'AttributeName': 'Location', 'AttributeType': 'S'}],
+                          GlobalSecondaryIndexes=[{'IndexName': 'LocationIndex', 'KeySchema': [{'AttributeName': 'Location', 'KeyType': 'HASH'}],
+                                                   'Projection': {'ProjectionType': 'ALL'}}],
+                          StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'})
+    for tableName, keyName in ((checkpointTable, 'StateKey'), (pendingJobsTable, 'JobId'), (resultCacheTable, 'CacheKey')):
+        dynamodb.create_table(TableName=tableName, BillingMode='PAY_PER_REQUEST',
+                              KeySchema=[{'AttributeName': keyName, 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': keyName, 'AttributeType': 'S'}])
+    boto3.client('s3', region_name=region).create_bucket(Bucket=bucketName)
+    boto3.client('sqs', region_name=region).create_queue(QueueName=queueName, Attributes={'FifoQueue': 'true', 'VisibilityTimeout': '300'})
+    return dynamodb.describe_table(TableName=tagsTable)['Table']['LatestStreamArn']
+
+def stream_batches(streamArn, batchSize):
+    # read the tags table stream, as the event source mapping of AVAIPopulateES would.
+    streams = boto3.client('dynamodbstreams', region_name=region)
+    for shard in streams.describe_stream(StreamArn=streamArn)['StreamDescription']['Shards']:
+        iterator = streams.get_shard_iterator(StreamArn=streamArn, ShardId=shard['ShardId'], ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+        while iterator:
+            response = streams.get_records(ShardIterator=iterator, Limit=batchSize)
+            if not response['Records']:
+                break
+            yield response['Records']
+            iterator = response.get('NextShardIterator')
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))] * 1000
+    return {'count': len(values), 'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1] * 1000}
+
+def set_environment(args):
+    os.environ.update({
+        'AWS_DEFAULT_REGION': region, 'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+        'VEEVA_DOMAIN_NAME': veevaDomain, 'VEEVA_DOMAIN_USERNAME': 'bench', 'VEEVA_DOMAIN_PASSWORD': 'bench',
+        'BUCKETNAME': bucketName, 'QUEUE_NAME': queueName, 'DDB_TABLE': tagsTable, 'ES_DOMAIN': esDomain,
+        'CHECKPOINT_TABLE': checkpointTable, 'PENDING_JOBS_TABLE': pendingJobsTable, 'RESULT_CACHE_TABLE': resultCacheTable,
+        'LOCATION_INDEX': 'LocationIndex', 'ASYNC_JOBS': 'true',
+        'TEXTRACT_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:bench', 'TEXTRACT_SNS_ROLE_ARN': 'arn:aws:iam::123456789012:role/bench',
+        'WORKERS': str(args.workers), 'DOWNLOAD_WORKERS': str(args.download_workers), 'INLINE_IMAGE_BYTES': str(args.inline_image_bytes),
+    })
+
+def profile_imports(runs):
+    # import each handler module in a fresh interpreter, as a cold start would, and report the fastest of the
+    # runs together with the slowest packages by cumulative import time from -X importtime.
+    script = ('import sys, time; sys.path[:0] = [{0!r}, {1!r}]; start = time.perf_counter(); import {2}; '
+              'print(time.perf_counter() - start)')
+    # modules that the interpreter imports on startup are not part of the handlers' cost.
+    startup = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'], capture_output=True, text=True, check=True).stderr
+    startupModules = set(line.split('|')[-1].strip() for line in startup.splitlines())
+    profile = collections.OrderedDict()
+    for moduleName in ('AVAIPoller', 'AVAIQueuePoller', 'AVAIPopulateES'):
+        best = None
+        for _ in range(runs):
+            completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', script.format(sourceDir, libDir, moduleName)],
+                                       capture_output=True, text=True, check=True)
+            seconds = float(completed.stdout.split()[-1])
+            if best is None or seconds < best[0]:
+                best = (seconds, completed.stderr)
+        # lines look like 'import time:   self [us] | cumulative | imported package', nesting shown by indentation
+        packages = {}
+        for line in best[1].splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                name = fields[2].strip()
+                if '.' not in name and name != moduleName and name not in startupModules:
+                    packages[name] = max(packages.get(name, 0), int(fields[1]) / 1000)
+        slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:5]
+        profile[moduleName] = {'ms': best[0] * 1000, 'slowestImportsMs': dict(slowest)}
+    return profile
+
+def run(args):
+    documents, contents = build_vault(args.documents, args.max_file_bytes, args.shared_content)
+    streamArn = create_resources()
+
+    sys.path[:0] = [sourceDir, libDir]
+    import AVAIPoller
+    import AVAIQueuePoller
+    import AVAIPopulateES
+
+    AVAIPoller.veevaSession.mount('https://{0}.veevavault.com'.format(veevaDomain),
+                                  VeevaStub(documents, contents, args.page_size, args.veeva_latency_ms / 1000))
+    AVAIPopulateES.get_es_session().mount('https://' + esDomain, ElasticsearchStub(args.es_latency_ms / 1000))
+    aiLatency = args.ai_latency_ms / 1000
+    textract = Textract(aiLatency, args.pdf_lines)
+    transcribe = Transcribe(aiLatency)
+    AVAIQueuePoller.rekognition.client = Rekognition(aiLatency)
+    AVAIQueuePoller.textract.client = textract
+    AVAIQueuePoller.transcribe.client = transcribe
+    AVAIQueuePoller.hera.client = ComprehendMedical(aiLatency)
+
+    stats.timed(AVAIPoller, 'process_document', 'poller.document')
+    stats.timed(AVAIPoller, 'enqueue_messages', 'poller.enqueue_page')
+    stats.timed(AVAIQueuePoller, 'handle_message', 'queuepoller.message')
+    stats.timed(AVAIQueuePoller, 'process_image', 'queuepoller.image')
+    stats.timed(AVAIQueuePoller, 'process_document', 'queuepoller.text')
+    stats.timed(AVAIPopulateES, 'send_bulk', 'es.bulk_request')
+    count_api_calls()
+
+    stages = collections.OrderedDict()
+    def stage(name, function):
+        # functions return the number of invocations and the time spent on harness work to leave out.
+        start = time.perf_counter()
+        invocations, harnessSeconds = function()
+        stages[name] = {'seconds': time.perf_counter() - start - harnessSeconds, 'invocations': invocations}
+
+    def poll_veeva():
+        # invoke the poller until the query has been processed completely.
+        invocations = 0
+        while True:
+            AVAIPoller.lambda_handler({}, Context(180))
+            invocations += 1
+            if AVAIPoller.checkpointStore.load_state()['nextPage'] is None:
+                return invocations, 0
+
+    def poll_queue():
+        # invoke the queue poller on its schedule until it finds the queue empty.
+        sqs = boto3.client('sqs', region_name=region)
+        queueUrl = sqs.get_queue_url(QueueName=queueName)['QueueUrl']
+        invocations = 0
+        while True:
+            start = time.perf_counter()
+            AVAIQueuePoller.lambda_handler({}, Context(300))
+            stats.record('queuepoller.invocation', time.perf_counter() - start)
+            invocations += 1
+            attributes = sqs.get_queue_attributes(QueueUrl=queueUrl, AttributeNames=['ApproximateNumberOfMessages'])['Attributes']
+            if int(attributes['ApproximateNumberOfMessages']) == 0:
+                return invocations, 0
+
+    def complete_jobs():
+        # deliver the Textract SNS notifications and Transcribe EventBridge events, one invocation per event.
+        events = [{'Records': [{'Sns': {'Message': json.dumps({'JobId': jobId, 'Status': 'SUCCEEDED'})}}]} for jobId in textract.jobs]
+        events += [{'source': 'aws.transcribe', 'detail': {'TranscriptionJobName': jobName, 'TranscriptionJobStatus': 'COMPLETED'}}
+                   for jobName in transcribe.jobs]
+        def invoke(event):
+            start = time.perf_counter()
+            AVAIQueuePoller.job_completion_handler(event, Context(300))
+            stats.record('jobcompletion.invocation', time.perf_counter() - start)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(invoke, events))
+        return len(events), 0
+
+    def populate_es():
+        # reading the stream from moto is slow, and is not part of the handler's time.
+        invocations = 0
+        streamSeconds = 0
+        batches = stream_batches(streamArn, args.stream_batch_size)
+        while True:
+            start = time.perf_counter()
+            records = next(batches, None)
+            streamSeconds += time.perf_counter() - start
+            if records is None:
+                return invocations, streamSeconds
+            start = time.perf_counter()
+            result = AVAIPopulateES.lambda_handler({'Records': records}, Context(180))
+            stats.record('es.invocation', time.perf_counter() - start)
+            stats.count('es.records', len(records))
+            stats.count('es.failed_records', len(result['batchItemFailures']))
+            invocations += 1
+
+    output = sys.stdout if args.verbose else open(os.devnull, 'w')
+    with contextlib.redirect_stdout(output):
+        stage('AVAIPoller', poll_veeva)
+        stage('AVAIQueuePoller', poll_queue)
+        stage('AVAIJobCompletion', complete_jobs)
+        stage('AVAIPopulateES', populate_es)
+
+    scans = boto3.client('dynamodb', region_name=region).get_paginator('scan').paginate(TableName=tagsTable, Select='COUNT')
+    rowCount = sum(page['Count'] for page in scans)
+    totalSeconds = sum(stage['seconds'] for stage in stages.values())
+    return {
+        'documents': args.documents,
+        'tagRows': rowCount,
+        'totalSeconds': totalSeconds,
+        'docsPerSecond': args.documents / totalSeconds,
+        'stages': {name: dict(stage, docsPerSecond=args.documents / stage['seconds']) for name, stage in stages.items()},
+        'latencyMs': {name: percentiles(values) for name, values in sorted(stats.durations.items())},
+        'apiCalls': dict(sorted(stats.calls.items())),
+        # ru_maxrss is in kilobytes on Linux
+        'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def report(result):
+    print('{0} documents, {1} tag rows in {2:.1f}s, {3:.1f} docs/sec, peak RSS {4:.0f} MB'.format(
+        result['documents'], result['tagRows'], result['totalSeconds'], result['docsPerSecond'], result['peakRssMB']))
+    print('\n{0:<20}{1:>10}{2:>13}{3:>10}'.format('stage', 'seconds', 'invocations', 'docs/sec'))
+    for name, stage in result['stages'].items():
+        print('{0:<20}{1:>10.2f}{2:>13}{3:>10.1f}'.format(name, stage['seconds'], stage['invocations'], stage['docsPerSecond']))
+    print('\n{0:<28}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}'.format('latency (ms)', 'count', 'p50', 'p95', 'p99', 'max'))
+    for name, latency in result['latencyMs'].items():
+        print('{0:<28}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(name, latency['count'], latency['p50'], latency['p95'], latency['p99'], latency['max']))
+    print('\n{0:<20}{1:>10}  {2}'.format('import (ms)', 'total', 'slowest imports'))
+    for name, profile in result['importTime'].items():
+        print('{0:<20}{1:>10.1f}  {2}'.format(name, profile['ms'], ', '.join('{0} {1:.0f}'.format(*item) for item in profile['slowestImportsMs'].items())))
+    print('\n{0:<52}{1:>12}'.format('api calls', 'count'))
+    for name, count in result['apiCalls'].items():
+        print('{0:<52}{1:>12}'.format(name, count))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a synthetic Veeva vault through the AVAI pipeline with local stubs.')
+    parser.add_argument('--documents', type=int, default=1000, help='number of documents in the synthetic vault')
+    parser.add_argument('--page-size', type=int, default=1000, help='documents per Veeva query page')
+    parser.add_argument('--max-file-bytes', type=int, default=65536, help='truncate the sample files to this size, 0 to keep them whole')
+    parser.add_argument('--shared-content', action='store_true', help='reuse the sample file bytes as is, so identical files hit the result cache')
+    parser.add_argument('--pdf-lines', type=int, default=200, help='lines of text returned by the Textract stub per PDF')
+    parser.add_argument('--ai-latency-ms', type=float, default=50, help='latency of every AI service call')
+    parser.add_argument('--veeva-latency-ms', type=float, default=20, help='latency of every Veeva call')
+    parser.add_argument('--es-latency-ms', type=float, default=10, help='latency of every Elasticsearch call')
+    parser.add_argument('--workers', type=int, default=10, help='WORKERS of the queue poller')
+    parser.add_argument('--download-workers', type=int, default=8, help='DOWNLOAD_WORKERS of the poller')
+    parser.add_argument('--inline-image-bytes', type=int, default=98304, help='INLINE_IMAGE_BYTES of the poller, 0 to send every image through S3')
+    parser.add_argument('--stream-batch-size', type=int, default=1000, help='stream records per AVAIPopulateES invocation')
+    parser.add_argument('--import-runs', type=int, default=3, help='fresh interpreters per module for the import-time profile')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the handlers')
+    args = parser.parse_args()
+
+    set_environment(args)
+    importTime = profile_imports(args.import_runs)
+    with mock_aws():
+        result = run(args)
+    result['importTime'] = importTime
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
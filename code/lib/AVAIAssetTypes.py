@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+# the asset formats the solution analyzes, deployed in the Lambda layer. AVAIPoller only downloads documents of
+# these MIME types and AVAIQueuePoller registers its processors for them, so a format is added in one place.
+
+# leading bytes checks of the formats, AVAIPoller sends the MIME type the downloaded bytes agree with, so a
+# document that is not what its format__v says is not sent to the wrong AI service.
+def is_jpeg(head):
+    return head.startswith(b'\xff\xd8\xff')
+def is_png(head):
+    return head.startswith(b'\x89PNG\r\n\x1a\n')
+def is_tiff(head):
+    return head[:4] in (b'II*\x00', b'MM\x00*')
+def is_pdf(head):
+    return head.startswith(b'%PDF-')
+def is_mp3(head):
+    return head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0)
+def is_mp4(head):
+    return head[4:8] == b'ftyp'
+def is_wav(head):
+    return head[:4] == b'RIFF' and head[8:12] == b'WAVE'
+def is_flac(head):
+    return head.startswith(b'fLaC')
+
+# the largest asset each processor takes, which the AI service would reject or which would cost more than allowed.
+# Rekognition only reads images up to 15 MB from S3.
+processorMaxBytes = {
+    'text': 10 * 1024 * 1024,
+    'audio': 2 * 1024 ** 3,
+    'document': 500 * 1024 * 1024,
+    'image': 15 * 1024 * 1024,
+}
+
+# MIME type: the processor of the type, its file extensions, the check of its leading bytes (None for formats
+# without a signature) and, for audio, the Transcribe media format.
+assetTypes = {
+    'image/jpeg': {'processor': 'image', 'extensions': ['jpg', 'jpeg'], 'signature': is_jpeg},
+    'image/png': {'processor': 'image', 'extensions': ['png'], 'signature': is_png},
+    'image/tiff': {'processor': 'document', 'extensions': ['tif', 'tiff'], 'signature': is_tiff},
+    'application/pdf': {'processor': 'document', 'extensions': ['pdf'], 'signature': is_pdf},
+    'text/plain': {'processor': 'text', 'extensions': ['txt'], 'signature': None},
+    'audio/mpeg': {'processor': 'audio', 'extensions': ['mp3'], 'signature': is_mp3, 'mediaFormat': 'mp3'},
+    'audio/mp3': {'processor': 'audio', 'extensions': [], 'signature': is_mp3, 'mediaFormat': 'mp3'},
+    'audio/mp4': {'processor': 'audio', 'extensions': ['m4a'], 'signature': is_mp4, 'mediaFormat': 'mp4'},
+    'video/mp4': {'processor': 'audio', 'extensions': ['mp4'], 'signature': is_mp4, 'mediaFormat': 'mp4'},
+    'audio/wav': {'processor': 'audio', 'extensions': ['wav'], 'signature': is_wav, 'mediaFormat': 'wav'},
+    'audio/x-wav': {'processor': 'audio', 'extensions': [], 'signature': is_wav, 'mediaFormat': 'wav'},
+    'audio/wave': {'processor': 'audio', 'extensions': [], 'signature': is_wav, 'mediaFormat': 'wav'},
+    'audio/flac': {'processor': 'audio', 'extensions': ['flac'], 'signature': is_flac, 'mediaFormat': 'flac'},
+    'audio/x-flac': {'processor': 'audio', 'extensions': [], 'signature': is_flac, 'mediaFormat': 'flac'},
+}
+
+# the images Rekognition can be given as bytes, which AVAIPoller may send in the queue message.
+inlineTypes = {'image/jpeg', 'image/png'}
+
+# the MIME type of each file extension, for messages that do not carry one.
+extensionTypes = {}
+for mimeType, assetType in assetTypes.items():
+    for extension in assetType['extensions']:
+        extensionTypes.setdefault(extension, mimeType)
+
+def processor_types(processor):
+    # the MIME types handled by processor.
+    return [mimeType for mimeType, assetType in assetTypes.items() if assetType['processor'] == processor]
+
+def sniff_mime_type(declaredType, head):
+    # the MIME type of a downloaded document: the declared one when the leading bytes agree with it (or it has no
+    # signature), otherwise the first supported type they match, None when they match none.
+    check = assetTypes[declaredType]['signature']
+    if check is None or check(head):
+        return declaredType
+    for mimeType, assetType in assetTypes.items():
+        check = assetType['signature']
+        if check is not None and check(head):
+            return mimeType
+    return None
@@ -0,0 +1,152 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+  
+#       http://www.apache.org/licenses/LICENSE-2.0
+  
+#   or in the "license" file accompanying this file. This file is distributed 
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either 
+#   express or implied. See the License for the specific language governing 
+#   permissions and limitations under the License.
+
+# call metrics shared by the Lambda functions, deployed in the Lambda layer.
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+# metrics of every external call made in an invocation, printed when the invocation ends in the CloudWatch
+# embedded metric format, so they are extracted from the log without calling the CloudWatch API.
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+metricsNamespace = os.environ.get('METRICS_NAMESPACE', 'AVAI')
+throttlingCodes = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                   'RequestLimitExceeded', 'LimitExceededException', 'SlowDown', 'RequestThrottled'}
+
+class Metrics:
+    # durations, call counts, bytes, errors and throttles by call name, e.g. s3.PutObject, Veeva.Query or ES._bulk.
+    def __init__(self, functionName):
+        self.functionName = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', functionName)
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(name + '.Errors')
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        # decorator recording every call of the function.
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def instrument(self, client):
+        # record every call made by a boto3 client, with the bytes sent and received and the throttled attempts.
+        events = client.meta.events
+        events.register('before-call', self.before_call)
+        events.register('before-send', self.before_send)
+        events.register('needs-retry', self.needs_retry)
+        events.register('after-call', self.after_call)
+        return client
+
+    def before_call(self, context, **kwargs):
+        context['metricsStart'] = time.perf_counter()
+
+    def before_send(self, request, event_name, **kwargs):
+        if request.headers.get('Content-Length'):
+            self.count(call_name(event_name) + '.BytesOut', int(request.headers['Content-Length']))
+
+    def needs_retry(self, response, event_name, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in throttlingCodes:
+            self.count(call_name(event_name) + '.Throttles')
+
+    def after_call(self, http_response, context, event_name, **kwargs):
+        name = call_name(event_name)
+        if 'metricsStart' in context:
+            self.record(name, time.perf_counter() - context['metricsStart'])
+        if http_response.headers.get('Content-Length'):
+            self.count(name + '.BytesIn', int(http_response.headers['Content-Length']))
+        if http_response.status_code >= 400:
+            self.count(name + '.Errors')
+
+    def instrument_session(self, session, name):
+        # record every request of a requests session, name(request) returns the call name.
+        def hook(response, **kwargs):
+            callName = name(response.request)
+            self.record(callName, response.elapsed.total_seconds())
+            if response.request.headers.get('Content-Length'):
+                self.count(callName + '.BytesOut', int(response.request.headers['Content-Length']))
+            if response.headers.get('Content-Length'):
+                self.count(callName + '.BytesIn', int(response.headers['Content-Length']))
+            if response.status_code == 429:
+                self.count(callName + '.Throttles')
+            elif response.status_code >= 400:
+                self.count(callName + '.Errors')
+        session.hooks['response'].append(hook)
+
+    def invocation(self, handler):
+        # decorator for a Lambda handler, printing the metrics of the invocation when it returns.
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            try:
+                with self.timer('Invocation'):
+                    return handler(event, context)
+            finally:
+                self.flush()
+        return wrapper
+
+    def flush(self):
+        with self.lock:
+            durations, counters = self.durations, self.counters
+            self.durations, self.counters = {}, {}
+        values = {}
+        definitions = []
+        for name, samples in sorted(durations.items()):
+            samples.sort()
+            values[name + '.Calls'] = len(samples)
+            values[name + '.p50'] = round(samples[(len(samples) - 1) // 2] * 1000, 3)
+            values[name + '.p95'] = round(samples[int((len(samples) - 1) * 0.95)] * 1000, 3)
+            definitions += [{'Name': name + '.Calls', 'Unit': 'Count'},
+                            {'Name': name + '.p50', 'Unit': 'Milliseconds'},
+                            {'Name': name + '.p95', 'Unit': 'Milliseconds'}]
+        for name, value in sorted(counters.items()):
+            values[name] = value
+            definitions.append({'Name': name, 'Unit': 'Bytes' if name.endswith(('.BytesIn', '.BytesOut')) else 'Count'})
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                # a directive can hold up to 100 metrics.
+                'CloudWatchMetrics': [{'Namespace': metricsNamespace, 'Dimensions': [['FunctionName']], 'Metrics': definitions[i:i+100]}
+                                      for i in range(0, len(definitions), 100)]
+            },
+            'FunctionName': self.functionName
+        }
+        record.update(values)
+        print(json.dumps(record))
+
+def call_name(eventName):
+    # 'after-call.s3.PutObject' -> 's3.PutObject'
+    return '.'.join(eventName.split('.')[1:3])
@@ -15,14 +15,21 @@
 import sys
 sys.path.insert(0, '/opt')
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from AVAIMetrics import Metrics
+from AVAIAssetTypes import assetTypes, inlineTypes, sniff_mime_type
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
-import urllib
 import json
+import base64
 import os
-import uuid
+import zlib
 import datetime
+import threading
+import time
 
 #read the environment variables
 veevaDomainName = unquote_plus(os.environ['VEEVA_DOMAIN_NAME']) 
@@ -41,76 +48,595 @@ queueName = unquote_plus(os.environ['QUEUE_NAME'])
 
 
 # Veeva URL formats.
+baseUrl = 'https://{0}.veevavault.com'.format(veevaDomainName)
 authUrl = 'https://{0}.veevavault.com/api/v20.1/auth'.format(veevaDomainName)
 dataUrl = 'https://{0}.veevavault.com/api/v20.1/'.format(veevaDomainName)
 
-s3 = boto3.client('s3')
-sqs = boto3.resource('sqs')
+# the query is read QUERY_PAGE_SIZE documents at a time, and a page is copied COPY_BATCH_SIZE documents at a time.
+# the copied versions are enqueued and recorded after every batch, and no new batch is started when less than
+# TIMEOUT_BUFFER_MILLIS is left in the invocation, so a run that stops in the middle of a page keeps the
+# documents it copied and the next run resumes the page from where it stopped.
+queryPageSize = int(os.environ.get('QUERY_PAGE_SIZE', '200'))
+timeoutBufferMillis = int(os.environ.get('TIMEOUT_BUFFER_MILLIS', '30000'))
 
-# specify the runDate global variable so it is initialized when the Lambda environment is initialized.
-# you can also use a dynamodb table to keep track of this date.
-# we use this date to get all the changes for the first run and then just the delta.
-runDate = datetime.datetime(1900, 1, 1) 
+# documents that could not be downloaded, uploaded or enqueued are kept in the checkpoint store and queried
+# again by id at the start of the next runs, since the delta query will not return them once runDate has moved
+# past them. A document is given up on after DOCUMENT_ATTEMPTS failed attempts.
+documentAttempts = int(os.environ.get('DOCUMENT_ATTEMPTS', '5'))
 
-def lambda_handler(event, context):
+# number of documents downloaded from Veeva and uploaded to S3 in parallel.
+downloadWorkers = int(os.environ.get('DOWNLOAD_WORKERS', '8'))
+copyBatchSize = int(os.environ.get('COPY_BATCH_SIZE', str(downloadWorkers * 4)))
+
+# size of the parts documents are streamed to S3 in, and the number of parts uploaded in parallel per document.
+# the download stream cannot seek, so s3transfer reads parts into memory ahead of the uploads, up to
+# UPLOAD_BUFFER_CHUNKS of them (its own default is 10). peak memory per document is roughly
+# uploadChunkMB * uploadBufferChunks, regardless of the document size, and DOWNLOAD_WORKERS times that per invocation.
+uploadChunkMB = int(os.environ.get('UPLOAD_CHUNK_MB', '8'))
+uploadConcurrency = int(os.environ.get('UPLOAD_CONCURRENCY', '4'))
+uploadBufferChunks = int(os.environ.get('UPLOAD_BUFFER_CHUNKS', str(uploadConcurrency)))
+transferConfig = TransferConfig(multipart_threshold=uploadChunkMB * 1024 * 1024,
+                                multipart_chunksize=uploadChunkMB * 1024 * 1024,
+                                max_concurrency=uploadConcurrency)
+transferConfig.max_in_memory_upload_chunks = uploadBufferChunks
+
+# messages are spread over this many FIFO message groups, keyed by document id, so the queue poller
+# can receive them in parallel while the versions of one document are still processed in order.
+messageGroups = int(os.environ.get('MESSAGE_GROUPS', '10'))
+
+# number of times entries that failed in a send_message_batch call are retried.
+sendRetries = int(os.environ.get('SEND_RETRIES', '3'))
+
+# JPEG and PNG images up to INLINE_IMAGE_BYTES are sent to the queue poller in the message, base64 encoded, and
+# analyzed from those bytes instead of the S3 copy, which is uploaded while the rest of the batch is downloaded.
+# A send_message_batch call takes up to maxBatchBytes of message bodies, so inline messages also
+# limit the number of entries per call. 0 turns inline images off.
+# the base64 encoded bytes of an image have to fit in a message of 256 KB.
+inlineImageBytes = min(int(os.environ.get('INLINE_IMAGE_BYTES', '98304')), 180 * 1024)
+maxBatchBytes = 256 * 1024 - 1024
+
+class PrefixedStream:
+    # file-like object that reads the bytes already taken from the stream to sniff its type, then the rest of it.
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+def veeva_call_name(request):
+    path = request.path_url.split('?')[0]
+    if path.endswith('/file'):
+        return 'Veeva.File'
+    if '/query' in path:
+        return 'Veeva.Query'
+    if path.endswith('/auth'):
+        return 'Veeva.Auth'
+    if path.endswith('/keep-alive'):
+        return 'Veeva.KeepAlive'
+    return 'Veeva.Other'
+
+metrics = Metrics('AVAIPoller')
+
+# the S3 client and the SQS queue are created on first use and reused while the container is warm.
+clientLock = threading.Lock()
+s3 = None
+sqsQueue = None
+
+def get_s3():
+    global s3
+    with clientLock:
+        if s3 is None:
+            s3 = metrics.instrument(boto3.client('s3', config=Config(max_pool_connections=downloadWorkers * (uploadConcurrency + 1))))
+        return s3
+
+def get_queue():
+    global sqsQueue
+    with clientLock:
+        if sqsQueue is None:
+            sqs = boto3.resource('sqs')
+            metrics.instrument(sqs.meta.client)
+            sqsQueue = sqs.get_queue_by_name(QueueName=queueName)
+        return sqsQueue
+
+# pooled keep-alive session shared by all Veeva calls, with a connection per download worker.
+veevaSession = requests.Session()
+veevaSession.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=downloadWorkers))
+metrics.instrument_session(veevaSession, veeva_call_name)
+
+# we use runDate to get all the changes for the first run and then just the delta.
+# it is kept in a checkpoint store so it survives cold starts, along with the checkpoint of a query
+# that did not finish within one invocation: nextPage is the Veeva page cursor to resume from,
+# queryDate is the time that query was started, which becomes the new runDate once all of its pages
+# have been processed.
+# the store also keeps the last version copied of every document, so unchanged versions are skipped
+# without downloading them again, and the number of failed attempts of the documents that could not be copied.
+defaultRunDate = datetime.datetime(1900, 1, 1)
+dateFormat = '%Y-%m-%dT%H:%M:%S.%f'
+
+class DynamoDBCheckpointStore:
+    # checkpoint store backed by a DynamoDB table with a string hash key named StateKey.
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.resource = None
+
+    @property
+    def table(self):
+        # the table resource is created on first use.
+        if self.resource is None:
+            self.resource = boto3.resource('dynamodb').Table(self.tableName)
+            metrics.instrument(self.resource.meta.client)
+        return self.resource
+
+    def load_state(self):
+        item = self.table.get_item(Key={'StateKey': 'RUN_STATE'}, ConsistentRead=True).get('Item', {})
+        return {'runDate': item.get('RunDate'), 'queryDate': item.get('QueryDate'), 'nextPage': item.get('NextPage')}
+
+    def save_state(self, state):
+        item = {'StateKey': 'RUN_STATE'}
+        if state['runDate'] is not None:
+            item['RunDate'] = state['runDate']
+        if state['queryDate'] is not None:
+            item['QueryDate'] = state['queryDate']
+        if state['nextPage'] is not None:
+            item['NextPage'] = state['nextPage']
+        self.table.put_item(Item=item)
+
+    def load_session(self):
+        return self.table.get_item(Key={'StateKey': 'VEEVA_SESSION'}, ConsistentRead=True).get('Item', {}).get('SessionId')
+
+    def save_session(self, sessionId):
+        self.table.put_item(Item={'StateKey': 'VEEVA_SESSION', 'SessionId': sessionId})
+
+    def get_versions(self, documentIds):
+        # returns {documentId: (major, minor)} for the documents that have been copied before.
+        versions = {}
+        documentIds = list(set(documentIds))
+        # batch_get_item accepts up to 100 keys per call.
+        for i in range(0, len(documentIds), 100):
+            request = {self.tableName: {'Keys': [{'StateKey': 'DOC#' + documentId} for documentId in documentIds[i:i+100]],
+                                        'ProjectionExpression': 'StateKey, Major, Minor'}}
+            while request:
+                response = self.table.meta.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.tableName, []):
+                    versions[item['StateKey'][4:]] = (int(item['Major']), int(item['Minor']))
+                request = response.get('UnprocessedKeys')
+        return versions
+
+    def put_versions(self, versions):
+        # batch writer for dyanmodb is efficient way to write multiple items.
+        with self.table.batch_writer(overwrite_by_pkeys=['StateKey']) as batch:
+            for documentId, (major, minor) in versions.items():
+                batch.put_item(Item={'StateKey': 'DOC#' + documentId, 'Major': major, 'Minor': minor})
+
+    def load_failed(self):
+        # returns {documentId: attempts} for the documents that could not be copied.
+        item = self.table.get_item(Key={'StateKey': 'FAILED_DOCUMENTS'}, ConsistentRead=True).get('Item', {})
+        return {documentId: int(attempts) for documentId, attempts in item.get('Documents', {}).items()}
+
+    def save_failed(self, failed):
+        self.table.put_item(Item={'StateKey': 'FAILED_DOCUMENTS', 'Documents': failed})
+
+class SQLiteCheckpointStore:
+    # local stand-in for the DynamoDB store, used when no checkpoint table is configured and for testing.
+    # with the default path under /tmp the checkpoint only lives as long as the Lambda container.
+    # the session is saved from the download workers when Veeva rejects it, so the connection is shared
+    # between threads behind a lock.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS versions (id TEXT PRIMARY KEY, major INTEGER, minor INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS session (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS failed (id TEXT PRIMARY KEY, attempts INTEGER)')
+        self.connection.commit()
+
+    def load_state(self):
+        state = {'runDate': None, 'queryDate': None, 'nextPage': None}
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM state').fetchall()
+        for key, value in rows:
+            state[key] = value
+        return state
+
+    def save_state(self, state):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM state')
+            self.connection.executemany('INSERT INTO state (key, value) VALUES (?, ?)',
+                                        [(key, value) for key, value in state.items() if value is not None])
+
+    def load_session(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM session WHERE key = 'sessionId'").fetchone()
+        return row[0] if row else None
+
+    def save_session(self, sessionId):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO session (key, value) VALUES ('sessionId', ?)", (sessionId,))
+
+    def get_versions(self, documentIds):
+        versions = {}
+        documentIds = list(set(documentIds))
+        for i in range(0, len(documentIds), 500):
+            batch = documentIds[i:i+500]
+            with self.lock:
+                rows = self.connection.execute('SELECT id, major, minor FROM versions WHERE id IN ({0})'.format(','.join('?' * len(batch))), batch).fetchall()
+            for documentId, major, minor in rows:
+                versions[documentId] = (major, minor)
+        return versions
+
+    def put_versions(self, versions):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO versions (id, major, minor) VALUES (?, ?, ?)',
+                                        [(documentId, major, minor) for documentId, (major, minor) in versions.items()])
+
+    def load_failed(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, attempts FROM failed').fetchall()
+        return dict(rows)
+
+    def save_failed(self, failed):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM failed')
+            self.connection.executemany('INSERT INTO failed (id, attempts) VALUES (?, ?)', list(failed.items()))
+
+if os.environ.get('CHECKPOINT_TABLE'):
+    checkpointStore = DynamoDBCheckpointStore(unquote_plus(os.environ['CHECKPOINT_TABLE']))
+else:
+    checkpointStore = SQLiteCheckpointStore(os.environ.get('CHECKPOINT_FILE', '/tmp/avai_checkpoint.db'))
+
+def document_version(document):
+    return (int(document['major_version_number__v']), int(document['minor_version_number__v']))
+
+# the Veeva session is cached in the warm container and reused across invocations.
+# a session that has been idle for less than sessionIdleSeconds is used as is, an older one is validated
+# with a keep-alive call first. Veeva expires sessions after 20 minutes of inactivity.
+# set SHARE_VEEVA_SESSION to true to also keep the session in the checkpoint store, so new containers reuse it.
+sessionIdleSeconds = int(os.environ.get('SESSION_IDLE_SECONDS', '900'))
+shareSession = os.environ.get('SHARE_VEEVA_SESSION', 'false').lower() == 'true'
+sessionLock = threading.Lock()
+sessionId = None
+sessionLastUsed = 0
+
+def authenticate():
     # attempt authentication with Veeva
     # https://developer.veevavault.com/api/20.1/#authentication
-    response = requests.post(authUrl,  data = {'username':veevaUserName, 'password': veevaPassword})
-    # print(response)
+    response = veevaSession.post(authUrl,  data = {'username':veevaUserName, 'password': veevaPassword})
     response = response.json()
+    if(response['responseStatus'] == 'SUCCESS'):
+        print ('Authentication Successful.')
+        return response['sessionId']
+    print ('Authentication NOT Successful.')
+    print (json.dumps(response))
+    return None
+
+def is_session_valid(candidateSessionId):
+    # https://developer.veevavault.com/api/20.1/#session-keep-alive
+    response = veevaSession.post(dataUrl+'keep-alive', headers={'Authorization': candidateSessionId})
+    return response.ok and response.json()['responseStatus'] == 'SUCCESS'
+
+def get_session(staleSessionId = None):
+    # returns a valid session id, authenticating only when there is no usable cached session.
+    # pass the session id a call was rejected with as staleSessionId to force a refresh.
+    global sessionId, sessionLastUsed
+    with sessionLock:
+        if staleSessionId is not None and sessionId != staleSessionId:
+            # another worker has already refreshed the session.
+            return sessionId
+        if staleSessionId is None:
+            if sessionId is None and shareSession:
+                sessionId = checkpointStore.load_session()
+                sessionLastUsed = 0
+            if sessionId is not None:
+                if time.time() - sessionLastUsed < sessionIdleSeconds or is_session_valid(sessionId):
+                    sessionLastUsed = time.time()
+                    return sessionId
+                print('Cached session has expired.')
+        sessionId = authenticate()
+        sessionLastUsed = time.time()
+        if sessionId is not None and shareSession:
+            checkpointStore.save_session(sessionId)
+        return sessionId
+
+def is_invalid_session(response):
+    if response.status_code == 401:
+        return True
+    if not response.headers.get('Content-Type', '').startswith('application/json'):
+        return False
+    errors = response.json().get('errors', [])
+    return any(error.get('type') == 'INVALID_SESSION_ID' for error in errors)
+
+def veeva_request(method, url, **kwargs):
+    # call Veeva with the cached session, refreshing it and retrying once if it has been rejected.
+    global sessionLastUsed
+    currentSessionId = get_session()
+    response = veevaSession.request(method, url, headers={'Authorization': currentSessionId}, **kwargs)
+    if is_invalid_session(response):
+        response.close()
+        print('Session rejected, authenticating again.')
+        currentSessionId = get_session(currentSessionId)
+        response = veevaSession.request(method, url, headers={'Authorization': currentSessionId}, **kwargs)
+    sessionLastUsed = time.time()
+    return response
+
+def query_documents(query, pageUrl = None):
+    # post the query and follow the page cursors, yielding one page of documents at a time
+    # together with the cursor of the page after it (None for the last page).
+    # https://developer.veevavault.com/api/20.1/#vault-query-language-vql
+    # https://developer.veevavault.com/api/20.1/#paginating-results
+    while True:
+        if pageUrl is None:
+            response = veeva_request('POST', dataUrl+'query', data = {'q': query})
+        else:
+            response = veeva_request('POST', baseUrl+pageUrl)
+        response = response.json()
+
+        if (response['responseStatus'] != 'SUCCESS'):
+            if pageUrl is not None:
+                # the page cursor has expired, start the query over.
+                print('Could not resume query from {0}, querying again.'.format(pageUrl))
+                print(json.dumps(response))
+                pageUrl = None
+                continue
+            print('Query NOT Successful.')
+            print(json.dumps(response))
+            return
+
+        pageUrl = response.get('responseDetails', {}).get('next_page')
+        yield response['data'], pageUrl
+
+        if pageUrl is None:
+            return
+
+@metrics.timed('CopyDocument')
+def process_document(document, uploader=None):
+    # download a single document from Veeva and copy it to S3.
+    # runs on the download workers, returns the queue message for the document or None if it was skipped, and
+    # the future of the S3 upload of an inline image, which is submitted to uploader instead of waited for.
+    # raises when the document could not be copied, so it is tried again by a later run.
+    declaredType = document['format__v']
+    # documents in formats AVAIQueuePoller has no processor for are skipped before they are downloaded.
+    if declaredType in assetTypes:
+        filename = document['filename__v']
+        print(('Downloading {0}').format(filename))
+        docImageUrl = ('objects/documents/{0}/versions/{1}/{2}/file').format(document['id'],document['major_version_number__v'],document['minor_version_number__v'])
+        with veeva_request('GET', dataUrl+docImageUrl, stream=True) as veeva_Doc:
+            if (veeva_Doc.headers['Content-Type'] == 'application/octet-stream;charset=UTF-8'):
+                veeva_Doc.raw.decode_content = True
+                head = veeva_Doc.raw.read(16)
+                mimeType = sniff_mime_type(declaredType, head)
+                if mimeType is None:
+                    print('Skipping {0}, its content is not {1}.'.format(filename, declaredType))
+                    return None, None
+                if mimeType != declaredType:
+                    print('{0} is {1}, not {2}.'.format(filename, mimeType, declaredType))
+                keyName = 'input/' + filename
+                # Create a new message
+                message = {}
+                message['mimeType'] = mimeType
+                message['bucketName'] = bucketName
+                message['keyName'] = keyName
+                if veeva_Doc.headers.get('Content-Length'):
+                    message['size'] = int(veeva_Doc.headers['Content-Length'])
+
+                if uploader is not None and mimeType in inlineTypes and message.get('size', 0) <= inlineImageBytes:
+                    # read one byte past the limit, the size is not always known up front.
+                    head += veeva_Doc.raw.read(inlineImageBytes + 1 - len(head))
+                    if len(head) <= inlineImageBytes:
+                        message['imageBytes'] = base64.b64encode(head).decode('ascii')
+                        return message, uploader.submit(get_s3().put_object, Bucket=bucketName, Key=keyName, Body=head)
 
-    global runDate
+                # stream the file to S3, uploading in parts as they are downloaded
+                get_s3().upload_fileobj(PrefixedStream(head, veeva_Doc.raw), bucketName, keyName, Config=transferConfig)
+                return message, None
+            else:
+                raise Exception(veeva_Doc.json()['errors'][0]['message'])
+    return None, None
 
+@metrics.timed('EnqueuePage')
+def enqueue_messages(queue, documents):
+    # put a message in SQS for every (document, message) pair, in as few send_message_batch calls as fit.
+    # returns the ids of the entries that were sent.
+    entries = []
+    for document, message in documents:
+        documentId = str(document['id'])
+        major, minor = document_version(document)
+        entries.append({
+            'Id': '{0}_{1}_{2}'.format(documentId, major, minor),
+            'MessageBody': json.dumps(message),
+            'MessageGroupId': 'messageGroup{0}'.format(zlib.crc32(documentId.encode('utf-8')) % messageGroups + 1),
+            # the same document version is only enqueued once, even if a page is processed twice.
+            'MessageDeduplicationId': '{0}-{1}-{2}'.format(documentId, major, minor)
+            })
+
+    # up to 10 entries per call, fewer when their bodies are larger than maxBatchBytes together.
+    batches = [[]]
+    batchBytes = 0
+    for entry in entries:
+        entryBytes = len(entry['MessageBody'].encode('utf-8'))
+        if len(batches[-1]) == 10 or (batches[-1] and batchBytes + entryBytes > maxBatchBytes):
+            batches.append([])
+            batchBytes = 0
+        batches[-1].append(entry)
+        batchBytes += entryBytes
+
+    sentIds = set()
+    for batch in batches:
+        attempt = 0
+        while batch:
+            print('sending {0} messages to queue {1}'.format(len(batch), queueName))
+            response = queue.send_messages(Entries=batch)
+            sentIds.update(entry['Id'] for entry in response.get('Successful', []))
+            failed = response.get('Failed', [])
+            for failure in failed:
+                print('Could not send message {0}: {1}'.format(failure['Id'], failure.get('Message')))
+            # only retry the entries that failed on the service side.
+            retryIds = set(failure['Id'] for failure in failed if not failure['SenderFault'])
+            batch = [entry for entry in batch if entry['Id'] in retryIds]
+            attempt += 1
+            if batch and attempt > sendRetries:
+                print('Giving up on {0} messages.'.format(len(batch)))
+                break
+            if batch:
+                time.sleep(0.1 * 2 ** attempt)
+    return sentIds
+
+def running_out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < timeoutBufferMillis
+
+def copy_documents(queue, documents, executor, uploader):
+    # download and upload the documents in parallel, and put a message in SQS for every document copied.
+    # returns the ids of the documents that could not be copied.
+    futures = [executor.submit(process_document, document, uploader if inlineImageBytes > 0 else None) for document in documents]
+    # the S3 copies of inline images are waited for before their messages are sent, so the queue and the tags
+    # table never refer to an image that is not in S3.
+    copied = []
+    failedIds = set()
+    for document, future in zip(documents, futures):
+        if future.exception() is not None:
+            # a failed document should not stop the rest of the page from being processed.
+            print('Something went wrong processing document {0}: {1}'.format(document['id'], future.exception()))
+            failedIds.add(str(document['id']))
+            continue
+        message, upload = future.result()
+        if message is None:
+            continue
+        if upload is not None and upload.exception() is not None:
+            print('Could not copy {0} to S3: {1}'.format(message['keyName'], upload.exception()))
+            failedIds.add(str(document['id']))
+            continue
+        copied.append((document, message))
+    sentIds = enqueue_messages(queue, copied)
+
+    # remember the versions that made it to S3 and to the queue, so they are not copied again.
+    newVersions = {}
+    for document, message in copied:
+        major, minor = document_version(document)
+        if '{0}_{1}_{2}'.format(document['id'], major, minor) in sentIds:
+            newVersions[str(document['id'])] = (major, minor)
+        else:
+            failedIds.add(str(document['id']))
+    checkpointStore.put_versions(newVersions)
+    return failedIds
+
+def copy_page(queue, documents, executor, uploader, context, failed):
+    # copy the new versions of a page of documents, copyBatchSize documents at a time, and keep the attempts of
+    # the documents that could not be copied in failed, {documentId: attempts}, which is saved after every batch.
+    # returns False when it ran out of time before the end of the page.
+    savedFailed = dict(failed)
+    copiedVersions = checkpointStore.get_versions([str(document['id']) for document in documents])
+    newDocuments = []
+    for document in documents:
+        if copiedVersions.get(str(document['id']), (-1, -1)) < document_version(document):
+            newDocuments.append(document)
+        else:
+            # skip the versions that have already been copied, without calling Veeva for them.
+            failed.pop(str(document['id']), None)
+    print('{0} new document versions in page.'.format(len(newDocuments)))
+
+    finished = True
+    for i in range(0, len(newDocuments), copyBatchSize):
+        if i > 0 and running_out_of_time(context):
+            finished = False
+            break
+        batch = newDocuments[i:i+copyBatchSize]
+        failedIds = copy_documents(queue, batch, executor, uploader)
+        for document in batch:
+            documentId = str(document['id'])
+            if documentId not in failedIds:
+                failed.pop(documentId, None)
+            elif failed.get(documentId, 0) + 1 >= documentAttempts:
+                print('Giving up on document {0} after {1} attempts.'.format(documentId, documentAttempts))
+                failed.pop(documentId, None)
+            else:
+                failed[documentId] = failed.get(documentId, 0) + 1
+        if failed != savedFailed:
+            checkpointStore.save_failed(failed)
+            savedFailed = dict(failed)
+    if failed != savedFailed:
+        checkpointStore.save_failed(failed)
+    return finished
+
+def retry_failed_documents(queue, failed, executor, uploader, context):
+    # query the documents that failed in earlier runs again by id, whatever their modified date, and copy them.
+    # documents a successful query no longer returns have been deleted and are dropped.
+    # returns the ids of the documents that were tried, which are not tried a second time in the same run.
+    tried = set()
+    documentIds = sorted(failed)
+    print('Retrying {0} documents that could not be copied.'.format(len(documentIds)))
+    for i in range(0, len(documentIds), queryPageSize):
+        if running_out_of_time(context):
+            return tried
+        batchIds = documentIds[i:i+queryPageSize]
+        query = 'SELECT id, format__v, filename__v, major_version_number__v, minor_version_number__v from documents'
+        query = '{0} where id contains ({1})'.format(query, ','.join(batchIds))
+        answered = False
+        found = set()
+        for documents, pageUrl in query_documents(query):
+            answered = True
+            found.update(str(document['id']) for document in documents)
+            tried.update(str(document['id']) for document in documents)
+            if not copy_page(queue, documents, executor, uploader, context, failed):
+                return tried
+        if answered and not found.issuperset(batchIds):
+            for documentId in set(batchIds) - found:
+                failed.pop(documentId, None)
+            checkpointStore.save_failed(failed)
+    return tried
+
+@metrics.invocation
+def lambda_handler(event, context):
     # Get the queue
-    queue = sqs.get_queue_by_name(QueueName=queueName)
-    keyName = ''
+    queue = get_queue()
 
-    if(response['responseStatus'] == 'SUCCESS'):
-        print ('Authentication Successful.')
-        sessionId = response['sessionId']
-        
-        #authHeader would be needed for subsequent calls. 
-        authHeader = {'Authorization': sessionId}
-        
-        
-        print('Querying Veeva for changes after {0}.'.format(str(runDate)))
+    if get_session() is not None:
+        # load the checkpoint of the previous run.
+        state = checkpointStore.load_state()
+        runDate = datetime.datetime.strptime(state['runDate'], dateFormat) if state['runDate'] else defaultRunDate
+        nextPage = state['nextPage']
 
         query = 'SELECT id, format__v, filename__v, major_version_number__v, minor_version_number__v, version_modified_date__v, version_creation_date__v from documents'
         query = "{0} where version_modified_date__v >= '{1}' or version_creation_date__v >= '{1}'".format(query, runDate.strftime("%Y-%m-%dT%H:%M:%S.000Z")) 
-        
-        #update runDate so that next time we just get the deltas from the last run.
-        runDate = datetime.datetime.utcnow()
-
-        payload = {'q': query}
-
-        # post the query
-        # https://developer.veevavault.com/api/20.1/#vault-query-language-vql
-        veeva_Docs = requests.post(dataUrl+'query', headers=authHeader, data = payload)
-        veeva_Docs = veeva_Docs.json()
-        if (veeva_Docs['responseStatus'] == 'SUCCESS'):
-            for document in veeva_Docs['data']:
-                if (document['format__v'] == 'image/jpeg' or document['format__v'] == 'image/png' or  document['format__v'] == 'application/pdf' or  document['format__v'] == 'audio/mp3'):
-                    filename = document['filename__v']
-                    print(('Downloading {0}').format(filename))
-                    docImageUrl = ('objects/documents/{0}/versions/{1}/{2}/file').format(document['id'],document['major_version_number__v'],document['minor_version_number__v'])
-                    veeva_Doc = requests.get(dataUrl+docImageUrl, headers=authHeader)
-                    if (veeva_Doc.headers['Content-Type'] == 'application/octet-stream;charset=UTF-8'):
-                        # copy image to S3
-                        keyName = 'input/' + filename
-                        response = s3.put_object(Bucket = bucketName, Key = keyName, Body = veeva_Doc.content)
-                        # put a message in SQS
-                        # Create a new message
-                        message = {}
-                        message['fileType'] = 'png'  # can be png, jpg, pdf, mp3
-                        message['bucketName'] = bucketName
-                        message['keyName'] = keyName
-
-                        print('sending message to queue ' + queueName)
-                        response = queue.send_message(MessageBody= json.dumps(message), MessageGroupId='messageGroup1', MessageDeduplicationId = str(uuid.uuid4()))
-                    else:
-                        print(veeva_Doc.json()['errors'][0]['message'])
-    else:
-        print ('Authentication NOT Successful.')
-        print (json.dumps(response))
+        query = '{0} PAGESIZE {1}'.format(query, queryPageSize)
+
+        if nextPage is None:
+            print('Querying Veeva for changes after {0}.'.format(str(runDate)))
+            state['queryDate'] = datetime.datetime.utcnow().strftime(dateFormat)
+        else:
+            print('Resuming query for changes after {0} from {1}.'.format(str(runDate), nextPage))
+
+        with ThreadPoolExecutor(max_workers=downloadWorkers) as executor, ThreadPoolExecutor(max_workers=downloadWorkers) as uploader:
+            failed = checkpointStore.load_failed()
+            tried = retry_failed_documents(queue, failed, executor, uploader, context) if failed else set()
+
+            # the changes are queried when the retries have left time for them.
+            pages = [] if running_out_of_time(context) else query_documents(query, nextPage)
+            for documents, pageUrl in pages:
+                documents = [document for document in documents if str(document['id']) not in tried]
+                if not copy_page(queue, documents, executor, uploader, context, failed):
+                    # the cursor is left at this page, the versions already copied from it are skipped next time.
+                    print('Running out of time, next run will resume the current page.')
+                    break
+
+                # checkpoint the page cursor so a timed out run resumes from the next page.
+                state['nextPage'] = pageUrl
+                if pageUrl is None:
+                    #update runDate so that next time we just get the deltas from the last run.
+                    state['runDate'] = state['queryDate']
+                    state['queryDate'] = None
+                    print('Query complete.')
+                checkpointStore.save_state(state)
+                if pageUrl is not None and running_out_of_time(context):
+                    print('Running out of time, next run will resume from {0}.'.format(pageUrl))
+                    break
 
     return 1
\ No newline at end of file
@@ -15,26 +15,86 @@ import sys
 sys.path.insert(0, '/opt')
 import boto3
 import requests
+from requests.adapters import HTTPAdapter
 from requests_aws4auth import AWS4Auth
+from AVAIMetrics import Metrics
 from urllib.parse import unquote_plus
 import json
 import os
-
-my_session = boto3.session.Session()
-region = my_session.region_name
+import time
+import hashlib
+import threading
+import datetime
 
 # variables that will be used in the code
 service = 'es'
-credentials = boto3.Session().get_credentials()
-awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
 host =  'https://{0}'.format(unquote_plus(os.environ['ES_DOMAIN']))
 index = 'avai_index'
-type = '_doc'
-docurl = host + '/' + index + '/' + type + '/'
 indexurl = host+ '/' + index
 headers = { "Content-Type": "application/json" }
+bulkurl = host + '/_bulk'
+bulkheaders = { "Content-Type": "application/x-ndjson" }
+
+# maximum size of one _bulk request body, and the number of times items that failed with a
+# retryable status (throttled or server side error) are sent again.
+bulkMaxBytes = int(os.environ.get('BULK_MAX_BYTES', str(5 * 1024 * 1024)))
+bulkRetries = int(os.environ.get('BULK_RETRIES', '3'))
+
+def es_call_name(request):
+    # 'https://domain/_bulk' -> 'ES._bulk', calls on an index itself -> 'ES.Index'
+    last = request.path_url.split('?')[0].rstrip('/').split('/')[-1]
+    return 'ES.' + (last if last.startswith('_') else 'Index')
+
+metrics = Metrics('AVAIPopulateES')
+
+# pooled keep-alive session that signs every request, created on first use and reused across
+# invocations of a warm container.
+sessionLock = threading.Lock()
+esSession = None
+
+def get_es_session():
+    global esSession
+    with sessionLock:
+        if esSession is None:
+            my_session = boto3.session.Session()
+            # the signer reads the current keys from the botocore credentials on every request,
+            # so it keeps working after the role credentials are rotated.
+            awsauth = AWS4Auth(refreshable_credentials=my_session.get_credentials(), region=my_session.region_name, service=service)
+            session = requests.Session()
+            session.auth = awsauth
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            metrics.instrument_session(session, es_call_name)
+            esSession = session
+        return esSession
+
+# ES_INDEX_MODE selects what is written for the tag rows in the DynamoDB table:
+#   rows   - one document per tag row in avai_index, as used by the dashboards in ESConfig.
+#   assets - one document per asset (S3 location) in avai_asset_index, holding all the tags of the asset.
+#   both   - both of the above.
+indexMode = os.environ.get('ES_INDEX_MODE', 'rows').lower()
+writeRows = indexMode in ('rows', 'both')
+writeAssets = indexMode in ('assets', 'both')
+assetIndex = 'avai_asset_index'
+assetindexurl = host + '/' + assetIndex
+
+# ES_ROLLOVER partitions the tag rows into time based indices named avai_index-<period> by their TimeStamp,
+# 'month' or 'day', which are created from the avai_index_template template and read through the avai_index alias.
+# with the default 'none' all the tag rows are written to the single avai_index index.
+rollover = os.environ.get('ES_ROLLOVER', 'none').lower()
+templateurl = host + '/_template/' + index + '_template'
+
+# settings of the indices, a longer refresh interval makes bulk heavy windows cheaper.
+indexSettings = {
+    "number_of_shards": int(os.environ.get('ES_SHARDS', '1')),
+    "number_of_replicas": int(os.environ.get('ES_REPLICAS', '1')),
+    "refresh_interval": os.environ.get('ES_REFRESH_INTERVAL', '30s')
+}
+
+# set once the indices have been created or verified in this container.
+indexReady = False
 
 index_body = {
+    "settings": indexSettings,
     "mappings": {
       "properties": {
         "ROWID": {
@@ -63,43 +123,376 @@ index_body = {
         },
         "TimeStamp": {
             "type": "date"
+        },
+        "Detect_Entities_Type": {
+            "type": "keyword"
+        },
+        "Detect_Entities_Category": {
+            "type": "keyword"
+        },
+        "Detect_Entities_Trait_List": {
+            "type": "keyword",
+            "ignore_above": 1024
+        },
+        "Detect_Entities_Attribute_List": {
+            "type": "keyword",
+            "ignore_above": 1024
         }
       }
     }
   }
 
-def lambda_handler(event, context):
+asset_index_body = {
+    "settings": indexSettings,
+    "mappings": {
+      "properties": {
+        "Location": {
+            "type": "keyword"
+        },
+        "AssetType": {
+            "type": "keyword"
+        },
+        "TimeStamp": {
+            "type": "date"
+        },
+        "TagCount": {
+            "type": "integer"
+        },
+        "RowIds": {
+            "type": "keyword"
+        },
+        "TagNames": {
+            "type": "keyword"
+        },
+        "Operations": {
+            "type": "keyword"
+        },
+        "Tags": {
+            "type": "nested",
+            "properties": index_body['mappings']['properties']
+        }
+      }
+    }
+  }
+
+# folds tag rows into an asset document: removes the rows listed in params.rowids, adds the rows in params.tags
+# (replacing rows with the same ROWID) and recomputes the flat keyword arrays used for terms aggregations.
+asset_script = {
+    "lang": "painless",
+    "source": """
+        if (ctx._source.Tags == null) { ctx._source.Tags = []; }
+        Set replaced = new HashSet(params.rowids);
+        for (t in params.tags) { replaced.add(t.ROWID); }
+        ctx._source.Tags.removeIf(t -> replaced.contains(t.ROWID));
+        ctx._source.Tags.addAll(params.tags);
+        List ids = new ArrayList();
+        Set names = new HashSet();
+        Set operations = new HashSet();
+        for (t in ctx._source.Tags) { ids.add(t.ROWID); names.add(t.Tag); operations.add(t.Operation); }
+        ctx._source.RowIds = ids;
+        ctx._source.TagNames = new ArrayList(names);
+        ctx._source.Operations = new ArrayList(operations);
+        ctx._source.TagCount = ids.size();
+        if (ctx._source.TimeStamp == null || params.timestamp > ctx._source.TimeStamp) { ctx._source.TimeStamp = params.timestamp; }
+        if (params.assetType != null) { ctx._source.AssetType = params.assetType; }
+    """
+}
+
+def to_item(document):
+    # create index document from the NewImage of a stream record
+    item = {}
+    item['AssetType'] = document['AssetType']['S']
+    item['Confidence'] = float(document['Confidence']['N'])
+    item['Operation'] = document['Operation']['S']
+    item['Tag'] = document['Tag']['S']
+    item['ROWID'] = document['ROWID']['S']
+    item['TimeStamp'] = int(document['TimeStamp']['N'])
+    if 'Face_Id' in document:
+        item['Face_Id'] = int(document['Face_Id']['N'])
+    if 'Value' in document:
+        item['Value'] = document['Value']['S']
+    item['Location'] = document['Location']['S']
+    for field in ['Detect_Entities_Type', 'Detect_Entities_Category', 'Detect_Entities_Trait_List', 'Detect_Entities_Attribute_List']:
+        if field in document:
+            item[field] = document[field]['S']
+    return item
+
+def row_index(timestamp):
+    # the index a tag row with the given TimeStamp (in milliseconds) is written to.
+    if rollover not in ('day', 'month'):
+        return index
+    return index + '-' + datetime.datetime.utcfromtimestamp(timestamp / 1000).strftime('%Y.%m.%d' if rollover == 'day' else '%Y.%m')
+
+def to_bulk_actions(record, oldImage):
+    # convert a DynamoDB stream record to the NDJSON lines of its _bulk actions, given the old image of the row
+    # as it is in the index (None if it is not known).
+    # returns None for a removed row whose index is not known, because there is no old image.
+    # Get the primary key for use as the Elasticsearch ID
+    id = record['dynamodb']['Keys']['ROWID']['S'] 
+    oldIndex = None
+    if oldImage is not None:
+        oldIndex = row_index(int(oldImage['TimeStamp']['N']))
     
+    if record['eventName'] == 'REMOVE':
+        if rollover not in ('day', 'month'):
+            return [json.dumps({'delete': {'_index': index, '_id': id}}) + '\n']
+        if oldIndex is None:
+            return None
+        return [json.dumps({'delete': {'_index': oldIndex, '_id': id}}) + '\n']
+
+    actions = []
+    item = to_item(record['dynamodb']['NewImage'])
+    newIndex = row_index(item['TimeStamp'])
+    if oldIndex is not None and oldIndex != newIndex:
+        # the row has moved to another time based index.
+        actions.append(json.dumps({'delete': {'_index': oldIndex, '_id': id}}) + '\n')
+    actions.append(json.dumps({'index': {'_index': newIndex, '_id': id}}) + '\n' + json.dumps(item) + '\n')
+    return actions
+
+def delete_rows(rowIds):
+    # delete tag rows from whichever time based index holds them, in one delete by query through the alias.
+    if not rowIds:
+        return True
+    body = {'query': {'ids': {'values': rowIds}}}
+    response = get_es_session().post(indexurl + '/_delete_by_query', json=body, headers=headers)
+    if not response.ok or response.json().get('failures'):
+        print('Could not delete rows: ' + response.text[:1000])
+        return False
+    return True
+
+def asset_id(location):
+    return hashlib.sha1(location.encode('utf-8')).hexdigest()
+
+def to_asset_actions(records):
+    # fold the tag rows of the batch by Location into one scripted update per asset, which adds the inserted
+    # and modified rows and drops the removed ones, found through the Location of their old image.
+    # returns (positions, action) pairs, where positions are the records each action carries,
+    # and the positions and ROWIDs of the removed rows without an old image, whose asset is not known.
+    # only the last change of each ROWID in the batch is applied.
+    latest = {}
+    for position, record in enumerate(records):
+        latest[record['dynamodb']['Keys']['ROWID']['S']] = position
+
+    assets = {}
+    removedPositions = []
+    removedRowIds = []
+    for rowId, position in latest.items():
+        record = records[position]
+        if record['eventName'] == 'REMOVE':
+            oldImage = record['dynamodb'].get('OldImage', {})
+            if 'Location' not in oldImage:
+                removedPositions.append(position)
+                removedRowIds.append(rowId)
+                continue
+            asset = assets.setdefault(oldImage['Location']['S'], {'positions': [], 'tags': [], 'rowids': [], 'assetType': None, 'timestamp': 0})
+            asset['positions'].append(position)
+            asset['rowids'].append(rowId)
+            continue
+        item = to_item(record['dynamodb']['NewImage'])
+        location = item.pop('Location')
+        asset = assets.setdefault(location, {'positions': [], 'tags': [], 'rowids': [], 'assetType': None, 'timestamp': 0})
+        asset['positions'].append(position)
+        asset['tags'].append(item)
+        asset['assetType'] = item['AssetType']
+        asset['timestamp'] = max(asset['timestamp'], item['TimeStamp'])
+
+    actions = []
+    for location, asset in assets.items():
+        update = {
+            'script': dict(asset_script, params={'tags': asset['tags'], 'rowids': asset['rowids'], 'timestamp': asset['timestamp'], 'assetType': asset['assetType']})
+        }
+        if asset['tags']:
+            update['scripted_upsert'] = True
+            update['upsert'] = {'Location': location, 'AssetType': asset['assetType'], 'TimeStamp': asset['timestamp'], 'Tags': []}
+        # an asset that only loses rows is not created, the update fails with 404 when it is not in the index.
+        action = json.dumps({'update': {'_index': assetIndex, '_id': asset_id(location), 'retry_on_conflict': 3}}) + '\n' + json.dumps(update) + '\n'
+        actions.append((asset['positions'], action))
+    return actions, removedPositions, removedRowIds
+
+def remove_asset_rows(rowIds):
+    # remove deleted tag rows from the asset documents that hold them, in one update by query, for the
+    # records without an old image.
+    if not rowIds:
+        return True
+    body = {
+        'query': {'terms': {'RowIds': rowIds}},
+        'script': dict(asset_script, params={'tags': [], 'rowids': rowIds, 'timestamp': 0, 'assetType': None})
+    }
+    response = get_es_session().post(assetindexurl + '/_update_by_query', json=body, headers=headers)
+    if not response.ok or response.json().get('failures'):
+        print('Could not remove rows from assets: ' + response.text[:1000])
+        return False
+    return True
+
+def bulk_batches(actions):
+    # group the (key, action) pairs into _bulk request bodies of at most bulkMaxBytes.
+    batch = []
+    size = 0
+    for key, action in actions:
+        actionSize = len(action.encode('utf-8'))
+        if batch and size + actionSize > bulkMaxBytes:
+            yield batch
+            batch = []
+            size = 0
+        batch.append((key, action))
+        size += actionSize
+    if batch:
+        yield batch
+
+def send_bulk(batch):
+    # send one _bulk request and return the keys of the items that failed, split into
+    # the ones worth retrying and the ones that will not succeed on a retry.
+    body = ''.join(action for key, action in batch)
+    response = get_es_session().post(bulkurl, data=body.encode('utf-8'), headers=bulkheaders)
+    if not response.ok:
+        print('Bulk request failed with status {0}: {1}'.format(response.status_code, response.text[:1000]))
+        if response.status_code == 429 or response.status_code >= 500:
+            return [key for key, action in batch], []
+        return [], [key for key, action in batch]
+
+    retryable = []
+    failed = []
+    result = response.json()
+    if result.get('errors'):
+        for (key, action), item in zip(batch, result['items']):
+            (operation, status), = item.items()
+            # deleting a document that is not in the index, or removing rows from an asset that is not, is not an error.
+            if status['status'] < 300 or (operation in ('delete', 'update') and status['status'] == 404):
+                continue
+            print('Could not {0} {1}: {2}'.format(operation, status.get('_id'), json.dumps(status.get('error'))))
+            if status['status'] == 429 or status['status'] >= 500:
+                retryable.append(key)
+            else:
+                failed.append(key)
+    return retryable, failed
+
+def ensure_index(name, url, body):
+    # create the index, or add any missing fields to its mapping.
+    global rollover
     # Check if index exists
-    response = requests.get(indexurl, auth=awsauth, headers=headers)
+    response = get_es_session().get(url, headers=headers)
     if not response.ok:
         # create index
-        response = requests.put(indexurl, auth=awsauth, json=index_body, headers=headers)
+        response = get_es_session().put(url, json=body, headers=headers)
+        print('Index {0} created.'.format(name) if response.ok else 'Could not create index: ' + response.text)
+    else:
+        # the response is keyed by the concrete indices, which are not the index itself when name is an alias.
+        indices = response.json()
+        if name == index and name not in indices:
+            # avai_index is the alias of time based indices created before rollover was turned off. It can not be
+            # written to as an index, so the rows keep going to the time based indices, by day or by month as
+            # their names show.
+            rollover = 'day' if any(len(concrete) == len(index) + len('-YYYY.MM.DD') for concrete in indices) else 'month'
+            print('{0} is an alias, not an index, writing to it with rollover by {1}.'.format(index, rollover))
+            return ensure_template()
+        if any(field not in concrete['mappings'].get('properties', {}) for concrete in indices.values() for field in body['mappings']['properties']):
+            response = get_es_session().put(url + '/_mapping', json=body['mappings'], headers=headers)
+            print('Index {0} mapping updated.'.format(name) if response.ok else 'Could not update index mapping: ' + response.text)
+        if response.ok:
+            # apply the current refresh interval, the other settings can only be set when the index is created.
+            response = get_es_session().put(url + '/_settings', json={'index': {'refresh_interval': indexSettings['refresh_interval']}}, headers=headers)
+    return response.ok
+
+def ensure_template():
+    # create or update the template of the time based indices, which adds them to the avai_index alias.
+    global rollover
+    response = get_es_session().get(indexurl, headers=headers)
+    if response.ok and index in response.json():
+        # avai_index is an index created before rollover was enabled, it can not also be an alias.
+        print('{0} is an index, not an alias, writing to it without rollover.'.format(index))
+        rollover = 'none'
+        return ensure_index(index, indexurl, index_body)
+    body = {
+        'index_patterns': [index + '-*'],
+        'settings': indexSettings,
+        'mappings': index_body['mappings'],
+        'aliases': {index: {}}
+    }
+    response = get_es_session().put(templateurl, json=body, headers=headers)
+    print('Index template updated.' if response.ok else 'Could not update index template: ' + response.text)
+    if response.ok:
+        # apply the current refresh interval to the existing indices as well.
+        get_es_session().put(host + '/' + index + '-*/_settings', json={'index': {'refresh_interval': indexSettings['refresh_interval']}}, headers=headers)
+    return response.ok
+
+def ensure_indices():
+    # bootstrap the indices once per container.
+    global indexReady
+    if indexReady:
+        return
+    ready = True
+    if writeRows and rollover in ('day', 'month'):
+        ready = ensure_template() and ready
+    elif writeRows:
+        ready = ensure_index(index, indexurl, index_body) and ready
+    if writeAssets:
+        ready = ensure_index(assetIndex, assetindexurl, asset_index_body) and ready
+    indexReady = ready
+
+@metrics.invocation
+def lambda_handler(event, context):
     
-    count = 0
-    for record in event['Records']:
-        # Get the primary key for use as the Elasticsearch ID
-        id = record['dynamodb']['Keys']['ROWID']['S'] 
-        
-        if record['eventName'] == 'REMOVE':
-            r = requests.delete(docurl + id, auth=awsauth)
-        else:
-            document = record['dynamodb']['NewImage']
-            # create index document
-            item = {}
-            item['AssetType'] = document['AssetType']['S']
-            item['Confidence'] = float(document['Confidence']['N'])
-            item['Operation'] = document['Operation']['S']
-            item['Tag'] = document['Tag']['S']
-            item['ROWID'] = document['ROWID']['S']
-            item['TimeStamp'] = int(document['TimeStamp']['N'])
-            if 'Face_Id' in document:
-                item['Face_Id'] = int(document['Face_Id']['N'])
-            if 'Value' in document:
-                item['Value'] = document['Value']['S']
-            item['Location'] = document['Location']['S']
-            # print(json.dumps(item))
-            r = requests.put(docurl + id, auth=awsauth, json=item, headers=headers)
-        count += 1
-        print(str(count) + ' records processed.')
-    return str(count) + ' records processed.'
\ No newline at end of file
+    ensure_indices()
+    
+    records = event['Records']
+    failed = []
+
+    # every action carries the positions of the stream records it writes.
+    actions = []
+    if writeRows:
+        # only the last change of each ROWID in the batch is written, as in to_asset_actions, so an item that is
+        # retried never overtakes a later change of the same row. It is applied against the row as it was before
+        # the batch, the old image of its first change.
+        first = {}
+        latest = {}
+        for position, record in enumerate(records):
+            rowId = record['dynamodb']['Keys']['ROWID']['S']
+            first.setdefault(rowId, position)
+            latest[rowId] = position
+        deletedPositions = []
+        deletedRowIds = []
+        for rowId, position in latest.items():
+            record = records[position]
+            oldImage = records[first[rowId]]['dynamodb'].get('OldImage') or record['dynamodb'].get('OldImage')
+            recordActions = to_bulk_actions(record, oldImage)
+            if recordActions is not None:
+                actions.extend(([position], action) for action in recordActions)
+            else:
+                deletedPositions.append(position)
+                deletedRowIds.append(rowId)
+        if not delete_rows(deletedRowIds):
+            failed.extend(deletedPositions)
+    if writeAssets:
+        assetActions, removedPositions, removedRowIds = to_asset_actions(records)
+        actions.extend(assetActions)
+        if not remove_asset_rows(removedRowIds):
+            failed.extend(removedPositions)
+
+    pending = list(enumerate(action for positions, action in actions))
+    attempt = 0
+    while pending:
+        retryable = []
+        for batch in bulk_batches(pending):
+            batchRetryable, batchFailed = send_bulk(batch)
+            retryable.extend(batchRetryable)
+            for key in batchFailed:
+                failed.extend(actions[key][0])
+
+        # retry only the items that were throttled or failed on the server, with backoff.
+        pending = [(key, actions[key][1]) for key in sorted(retryable)]
+        attempt += 1
+        if pending and attempt > bulkRetries:
+            for key, action in pending:
+                failed.extend(actions[key][0])
+            break
+        if pending:
+            print('Retrying {0} items.'.format(len(pending)))
+            time.sleep(0.5 * 2 ** attempt)
+
+    failed = sorted(set(failed))
+    print('{0} records processed, {1} failed.'.format(len(records) - len(failed), len(failed)))
+    metrics.count('Records', len(records))
+    metrics.count('FailedRecords', len(failed))
+
+    # report the failed records, so the stream is retried from the first one instead of replaying the whole batch.
+    return {'batchItemFailures': [{'itemIdentifier': records[position]['dynamodb']['SequenceNumber']} for position in failed]}
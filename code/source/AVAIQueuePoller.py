@@ -16,94 +16,573 @@
 import sys
 sys.path.insert(0, '/opt')
 import boto3
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from AVAIMetrics import Metrics
+from AVAIAssetTypes import assetTypes, extensionTypes, processorMaxBytes, processor_types
 import json
+import base64
+import random
 import uuid
 import decimal
 import time
 import os
+import threading
+import hashlib
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as EndpointError, HTTPClientError
 from urllib.parse import unquote_plus
 
-dynamoDBResource = boto3.resource('dynamodb', region_name = 'us-east-1')
-
-sqs = boto3.client('sqs')
-rekognition = boto3.client('rekognition')
-hera  = boto3.client(service_name='comprehendmedical', use_ssl=True, region_name = 'us-east-1')
-textract = boto3.client('textract',region_name='us-east-1')
-transcribe = boto3.client('transcribe',region_name='us-east-1')
-s3 = boto3.resource('s3')
-
-
 # read the environment variables
 queueName = unquote_plus(os.environ['QUEUE_NAME'])
 
 ddb_table = unquote_plus(os.environ['DDB_TABLE'])
 
-table = dynamoDBResource.Table(ddb_table)
+# number of messages processed in parallel.
+workers = int(os.environ.get('WORKERS', '10'))
+
+# visibility timeout of received messages, extended while a message is still being processed.
+visibilityTimeout = int(os.environ.get('VISIBILITY_TIMEOUT', '90'))
+
+# when invoked by the schedule, batches of messages are received until less than this time is left.
+drainTimeBufferMillis = int(os.environ.get('DRAIN_TIME_BUFFER_MILLIS', '60000'))
+
+# when ASYNC_JOBS is true, Textract and Transcribe jobs are only started here and recorded as pending jobs.
+# they are finished by job_completion_handler when the service reports the job as done, through SNS for
+# Textract and EventBridge for Transcribe, instead of polling for the job status in this function.
+asyncJobs = os.environ.get('ASYNC_JOBS', 'false').lower() == 'true'
+textractTopicArn = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+textractRoleArn = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+
+# pending jobs are kept for as long as the services keep the job results. A scheduled invocation of
+# job_completion_handler finishes the jobs that are still pending JOB_SWEEP_AGE_MINUTES after they were started,
+# whose completion event was lost or could not be processed.
+pendingJobTTL = 7 * 24 * 3600
+jobSweepAge = int(os.environ.get('JOB_SWEEP_AGE_MINUTES', '30')) * 60
+
+# comprehend medical has a input size limit of 20,000 bytes, longer text is split in chunks under this size
+# that overlap by a few characters, and the chunks are sent in parallel within the transaction rate limit.
+chunkBytes = int(os.environ.get('CHUNK_BYTES', '20000'))
+chunkOverlap = int(os.environ.get('CHUNK_OVERLAP', '200'))
+chunkWorkers = int(os.environ.get('CHUNK_WORKERS', '4'))
+comprehendMedicalTPS = float(os.environ.get('COMPREHEND_MEDICAL_TPS', '10'))
+
+# AI service results are cached by the content they were computed from (S3 ETag of images, SHA-256 of text),
+# so assets reused across documents and versions are only analyzed once.
+# the cache is kept in the RESULT_CACHE_TABLE DynamoDB table when set, otherwise in memory in the container.
+resultCacheTTL = int(os.environ.get('RESULT_CACHE_TTL_HOURS', '720')) * 3600
+resultCacheSize = int(os.environ.get('RESULT_CACHE_SIZE', '256'))
+
+# LOCATION_INDEX is a global secondary index of the tags table on Location. When set, the rows written for an
+# asset by a previous run are read back from it, so reprocessing the asset (a new document version or a redelivered
+# message) only writes the rows that changed and deletes the rows that are no longer found, instead of adding rows.
+locationIndex = os.environ.get('LOCATION_INDEX')
+
+# FACE_DETECTION=speculative calls detect_faces for every image together with detect_labels, trading the cost
+# of face detection on images without people for latency; gated only calls it once a person has been detected.
+faceDetection = os.environ.get('FACE_DETECTION', 'gated').lower()
+
+# calls to the AI services are rate limited per service, starting at the configured transactions per second.
+# the rate is halved when a service throttles and recovers gradually on success, and throttled or failed calls
+# are retried with jittered exponential backoff while the service's retry budget lasts.
+# the budget is refilled by RETRY_BUDGET_RATIO retries per successful call up to RETRY_BUDGET_MAX, so a service
+# that keeps failing is not hammered with retries and its messages are left on the queue to be tried again later.
+rekognitionTPS = float(os.environ.get('REKOGNITION_TPS', '50'))
+textractTPS = float(os.environ.get('TEXTRACT_TPS', '10'))
+transcribeTPS = float(os.environ.get('TRANSCRIBE_TPS', '10'))
+maxAttempts = int(os.environ.get('MAX_ATTEMPTS', '6'))
+maxBackoff = float(os.environ.get('MAX_BACKOFF_SECONDS', '20'))
+retryBudgetRatio = float(os.environ.get('RETRY_BUDGET_RATIO', '0.2'))
+retryBudgetMax = float(os.environ.get('RETRY_BUDGET_MAX', '50'))
+
+# error codes returned when a service is throttling or temporarily unavailable.
+retryableErrors = {
+    'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded', 'LimitExceededException', 'ServiceUnavailable', 'ServiceUnavailableException',
+    'InternalServerError', 'InternalServerException', 'InternalFailure'
+}
+throttlingErrors = retryableErrors - {'ServiceUnavailable', 'ServiceUnavailableException', 'InternalServerError', 'InternalServerException', 'InternalFailure'}
+
+metrics = Metrics('AVAIQueuePoller')
+
+clientConfig = Config(max_pool_connections=max(10, workers * 3, workers * chunkWorkers))
+# the AI service clients do not retry by themselves, ServiceClient does.
+aiClientConfig = clientConfig.merge(Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+class RateLimiter:
+    # token bucket shared by all threads, allowing `rate` calls per second with bursts of up to `rate` calls.
+    # the rate is halved when the service throttles and grows back by a tenth of the maximum on success.
+    def __init__(self, rate):
+        self.maxRate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(1.0, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+
+    def succeeded(self):
+        if self.rate < self.maxRate:
+            with self.lock:
+                self.rate = min(self.maxRate, self.rate + self.maxRate / 10)
+
+class RetryBudget:
+    # retries allowed for a service, earned by successful calls.
+    def __init__(self, ratio, limit):
+        self.ratio = ratio
+        self.limit = limit
+        self.tokens = limit
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.limit, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class ServiceClient:
+    # wraps a boto3 client so every operation is rate limited and retried, e.g. rekognition.detect_labels(...).
+    # the client is created on the first call.
+    def __init__(self, name, rate, **clientArgs):
+        self.name = name
+        self.client = None
+        self.clientArgs = clientArgs
+        self.limiter = RateLimiter(rate)
+        self.budget = RetryBudget(retryBudgetRatio, retryBudgetMax)
+
+    def __getattr__(self, operation):
+        if self.client is None:
+            self.client = get_client(self.name, config=aiClientConfig, **self.clientArgs)
+        method = getattr(self.client, operation)
+        return lambda **kwargs: self.call(operation, method, kwargs)
+
+    def call(self, operation, method, kwargs):
+        attempt = 1
+        while True:
+            self.limiter.acquire()
+            try:
+                response = method(**kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in retryableErrors:
+                    raise
+                if code in throttlingErrors:
+                    self.limiter.throttled()
+                error = e
+            except (EndpointError, HTTPClientError) as e:
+                error = e
+            else:
+                self.limiter.succeeded()
+                self.budget.deposit()
+                return response
+
+            # detect_labels -> rekognition.DetectLabels, as recorded by metrics.instrument
+            callName = '{0}.{1}'.format(self.name, ''.join(part.title() for part in operation.split('_')))
+            if attempt >= maxAttempts or not self.budget.withdraw():
+                print('{0}.{1} failed after {2} attempts: {3}'.format(self.name, operation, attempt, error))
+                metrics.count(callName + '.GaveUp')
+                raise error
+            metrics.count(callName + '.Retries')
+            # full jitter: sleep a random time up to the exponential backoff
+            backoff = random.uniform(0, min(maxBackoff, 0.5 * 2 ** attempt))
+            print('{0}.{1} failed ({2}), retrying in {3:.2f}s'.format(self.name, operation, error, backoff))
+            time.sleep(backoff)
+            attempt += 1
+
+# boto3 clients are created when they are first used, so an invocation only pays for the clients it needs.
+# clients are thread safe and shared by all threads, including the short-lived ones of the per-batch, per-image
+# and per-document pools, so each service has one connection pool for the container. boto3 resources are not
+# thread safe and are not used.
+clientLock = threading.RLock()
+botoSession = None
+clients = {}
+
+def get_boto_session():
+    global botoSession
+    with clientLock:
+        if botoSession is None:
+            botoSession = boto3.session.Session()
+        return botoSession
+
+def get_client(name, **kwargs):
+    if name not in clients:
+        with clientLock:
+            if name not in clients:
+                clients[name] = metrics.instrument(get_boto_session().client(name, **kwargs))
+    return clients[name]
+
+def get_sqs():
+    return get_client('sqs', config=clientConfig)
+
+queueUrl = None
+rekognition = ServiceClient('rekognition', rekognitionTPS)
+hera  = ServiceClient('comprehendmedical', comprehendMedicalTPS, use_ssl=True, region_name = 'us-east-1')
+textract = ServiceClient('textract', textractTPS, region_name='us-east-1')
+transcribe = ServiceClient('transcribe', transcribeTPS, region_name='us-east-1')
+
+def get_dynamodb():
+    return get_client('dynamodb', config=clientConfig, region_name = 'us-east-1')
+
+def get_s3():
+    return get_client('s3', config=clientConfig)
+
+# items are converted to and from DynamoDB attribute values here, as the boto3 Table resource would.
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+def to_attributes(item):
+    return {k: serializer.serialize(v) for (k, v) in item.items()}
+
+def from_attributes(attributes):
+    return {k: deserializer.deserialize(v) for (k, v) in attributes.items()}
+
+def batch_write(tableName, requests):
+    # sends the PutRequest/DeleteRequest entries in batches of 25, sending the unprocessed ones again,
+    # as the boto3 batch_writer does.
+    pending = list(requests)
+    while pending:
+        batch, pending = pending[:25], pending[25:]
+        response = get_dynamodb().batch_write_item(RequestItems={tableName: batch})
+        pending = response.get('UnprocessedItems', {}).get(tableName, []) + pending
+
 
+class DynamoDBPendingJobStore:
+    # pending jobs kept in a DynamoDB table with a string hash key named JobId.
+    # records expire through the table's ExpiresAt TTL attribute if a completion is never received.
+    def __init__(self, tableName):
+        self.tableName = tableName
 
+    def put_job(self, jobId, job):
+        item = dict(job)
+        item['JobId'] = jobId
+        item['ExpiresAt'] = int(time.time()) + pendingJobTTL
+        get_dynamodb().put_item(TableName=self.tableName, Item=to_attributes(item))
+
+    def get_job(self, jobId):
+        item = get_dynamodb().get_item(TableName=self.tableName, Key=to_attributes({'JobId': jobId}), ConsistentRead=True).get('Item')
+        return None if item is None else from_attributes(item)
+
+    def list_jobs(self, startedBefore):
+        # yields (job id, job) for the jobs started before the given time.
+        scanArgs = {'TableName': self.tableName, 'FilterExpression': 'ExpiresAt < :expiresAt',
+                    'ExpressionAttributeValues': to_attributes({':expiresAt': int(startedBefore) + pendingJobTTL})}
+        while True:
+            response = get_dynamodb().scan(**scanArgs)
+            for item in map(from_attributes, response['Items']):
+                yield item['JobId'], item
+            if 'LastEvaluatedKey' not in response:
+                return
+            scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def delete_job(self, jobId):
+        get_dynamodb().delete_item(TableName=self.tableName, Key=to_attributes({'JobId': jobId}))
+
+class SQLitePendingJobStore:
+    # local stand-in for the DynamoDB store, used when no pending jobs table is configured and for testing.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT)')
+        self.connection.commit()
+
+    def put_job(self, jobId, job):
+        item = dict(job, ExpiresAt=int(time.time()) + pendingJobTTL)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO jobs (id, job) VALUES (?, ?)', (jobId, json.dumps(item)))
+
+    def get_job(self, jobId):
+        with self.lock:
+            row = self.connection.execute('SELECT job FROM jobs WHERE id = ?', (jobId,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete_job(self, jobId):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM jobs WHERE id = ?', (jobId,))
+
+    def list_jobs(self, startedBefore):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, job FROM jobs').fetchall()
+        for jobId, job in rows:
+            job = json.loads(job)
+            if job.get('ExpiresAt', 0) < startedBefore + pendingJobTTL:
+                yield jobId, job
+
+if os.environ.get('PENDING_JOBS_TABLE'):
+    pendingJobStore = DynamoDBPendingJobStore(unquote_plus(os.environ['PENDING_JOBS_TABLE']))
+else:
+    pendingJobStore = SQLitePendingJobStore(os.environ.get('PENDING_JOBS_FILE', '/tmp/avai_pending_jobs.db'))
+
+class DynamoDBResultCache:
+    # results kept compressed in a DynamoDB table with a string hash key named CacheKey,
+    # expiring through the table's ExpiresAt TTL attribute.
+    # results that do not fit in a DynamoDB item are not cached.
+    maxBytes = 350 * 1024
+
+    def __init__(self, tableName):
+        self.tableName = tableName
+
+    def get(self, key):
+        item = get_dynamodb().get_item(TableName=self.tableName, Key=to_attributes({'CacheKey': key})).get('Item')
+        if item is None:
+            return None
+        item = from_attributes(item)
+        if item['ExpiresAt'] < time.time():
+            return None
+        return json.loads(zlib.decompress(item['Result'].value))
+
+    def put(self, key, result):
+        data = zlib.compress(json.dumps(result).encode('utf-8'))
+        if len(data) > self.maxBytes:
+            return
+        get_dynamodb().put_item(TableName=self.tableName, Item=to_attributes({'CacheKey': key, 'Result': data, 'ExpiresAt': int(time.time()) + resultCacheTTL}))
+
+class MemoryResultCache:
+    # local stand-in for the DynamoDB cache, holding the most recently used results of the container.
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expiresAt, data = entry
+            if expiresAt < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        # results are stored serialized, so callers can modify what they get back.
+        return json.loads(zlib.decompress(data))
+
+    def put(self, key, result):
+        data = zlib.compress(json.dumps(result).encode('utf-8'))
+        with self.lock:
+            self.entries[key] = (time.time() + resultCacheTTL, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+if os.environ.get('RESULT_CACHE_TABLE'):
+    resultCache = DynamoDBResultCache(unquote_plus(os.environ['RESULT_CACHE_TABLE']))
+else:
+    resultCache = MemoryResultCache(resultCacheSize)
+
+def cached_call(key, call):
+    # return the cached result for key, or make the call and cache its result.
+    result = resultCache.get(key)
+    if result is not None:
+        print('Using cached result for ' + key)
+        return result
+    result = call()
+    result.pop('ResponseMetadata', None)
+    resultCache.put(key, result)
+    return result
+
+def content_key(bucketName, keyName):
+    # identifies the content of an S3 object, the same bytes uploaded the same way have the same ETag.
+    response = get_s3().head_object(Bucket=bucketName, Key=keyName)
+    return '{0}-{1}'.format(response['ETag'].strip('"'), response['ContentLength'])
+
+def get_queue_url():
+    # the queue URL is looked up once per container.
+    global queueUrl
+    if queueUrl is None:
+        queueUrl = get_sqs().get_queue_url(QueueName=queueName)['QueueUrl']
+    return queueUrl
+
+def from_record(record):
+    # messages delivered by an SQS event source mapping, in the shape returned by receive_message.
+    return {
+        'MessageId': record['messageId'],
+        'ReceiptHandle': record['receiptHandle'],
+        'Body': record['body'],
+        'Attributes': record.get('attributes', {})
+    }
+
+def handle_messages(queue_url, messages, delete=True):
+    # process the messages in parallel, the messages of a FIFO message group one after the other in order.
+    # once a message of a group fails, the later messages of the group are not processed either and are left
+    # on the queue with it. returns the ids of the messages that were not processed.
+    groups = OrderedDict()
+    for message in messages:
+        groupId = message.get('Attributes', {}).get('MessageGroupId', message['MessageId'])
+        groups.setdefault(groupId, []).append(message)
+
+    def handle_group(group):
+        for (index, message) in enumerate(group):
+            if not handle_message(queue_url, message, delete):
+                return [m['MessageId'] for m in group[index:]]
+        return []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [messageId for failed in executor.map(handle_group, groups.values()) for messageId in failed]
+
+@metrics.invocation
 def lambda_handler(event, context):
 
-    # get the queue URL
-    queue_url = sqs.get_queue_url(
-                            QueueName=queueName
-                        )['QueueUrl']
-    
-    # Receive messages from SQS queue
-    response = sqs.receive_message(
-        QueueUrl=queue_url,
-        MaxNumberOfMessages=10,
-        MessageAttributeNames=[
-            'All'
-        ],
-        VisibilityTimeout=90,
-        WaitTimeSeconds=3
-    )
-    
-    if 'Messages' in response:
+    queue_url = get_queue_url()
+
+    # invoked by an SQS event source mapping with a batch of messages. Lambda deletes the messages that are
+    # not reported back as failed.
+    if 'Records' in event:
+        messages = [from_record(record) for record in event['Records']]
+        print (('Received {0} messages, processing').format(len(messages)))
+        failed = handle_messages(queue_url, messages, delete=False)
+        return {'batchItemFailures': [{'itemIdentifier': messageId} for messageId in failed]}
+
+    # invoked by the schedule, keep receiving messages until the queue is empty or the time is almost up.
+    while True:
+        # Receive messages from SQS queue
+        response = get_sqs().receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=10,
+            AttributeNames=[
+                'MessageGroupId'
+            ],
+            MessageAttributeNames=[
+                'All'
+            ],
+            VisibilityTimeout=visibilityTimeout,
+            WaitTimeSeconds=3
+        )
+        
+        if 'Messages' not in response:
+            print ('No messages found in queue.')
+            break
+
         print (('Found {0} messages, processing').format(str(len(response['Messages']))))
-        for message in response['Messages']:
-            receipt_handle = message['ReceiptHandle']
-            
-            messageBody = json.loads(message['Body'])
-            
-            try:
-                
-                if (messageBody['keyName'].lower().endswith('.jpg') 
-                        or messageBody['keyName'].lower().endswith('.jpeg') 
-                        or messageBody['keyName'].lower().endswith('.png')):
-                    # Process the image.
-                    process_image(messageBody)
-                    
-                if (messageBody['keyName'].lower().endswith('.txt')):
-                    print("Processing Document: {0}/{1}".format(messageBody['bucketName'], messageBody['keyName']))
-                    #get the S3 object
-                    bucket = s3.Bucket(messageBody['bucketName'])
-                    fileText = bucket.Object(messageBody['keyName']).get()['Body'].read().decode("utf-8", 'ignore')
-                    # Process the text document.
-                    process_document(messageBody['bucketName'], messageBody['keyName'], fileText, 'Text-file')
-
-                if (messageBody['keyName'].lower().endswith('.pdf')):
-                    # process PDF
-                    process_pdf(messageBody)
-
-                if (messageBody['keyName'].lower().endswith('.mp3') 
-                    or messageBody['keyName'].lower().endswith('.mp4') 
-                    or messageBody['keyName'].lower().endswith('.flac') 
-                    or messageBody['keyName'].lower().endswith('.wav')):
-                    # process Audio
-                    process_audio(messageBody)
-            except:
-                print("Something went wrong processing " + str(messageBody['keyName']))
-
-            # Delete received message from queue
-            sqs.delete_message(
+        # each message is acknowledged as soon as it is done.
+        handle_messages(queue_url, response['Messages'])
+
+        if context is None or context.get_remaining_time_in_millis() < drainTimeBufferMillis:
+            break
+
+def keep_visible(queue_url, receipt_handle, done):
+    # extend the visibility timeout of a message until it has been processed,
+    # so long running jobs are not handed out to another poller.
+    while not done.wait(visibilityTimeout / 2):
+        try:
+            get_sqs().change_message_visibility(
                 QueueUrl=queue_url,
-                ReceiptHandle=receipt_handle
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=visibilityTimeout
             )
-            # print('Received and deleted message: %s' % message)
-    else:
-        print ('No messages found in queue.')
+        except Exception as e:
+            print('Could not extend message visibility: ' + str(e))
+
+@metrics.timed('Message')
+def handle_message(queue_url, message, delete=True):
+    receipt_handle = message['ReceiptHandle']
 
+    done = threading.Event()
+    heartbeat = threading.Thread(target=keep_visible, args=(queue_url, receipt_handle, done), daemon=True)
+    heartbeat.start()
+    
+    try:
+        messageBody = json.loads(message['Body'])
+        process_message(messageBody)
+    except Exception as e:
+        # the message is not deleted, it becomes visible again after the visibility timeout and is retried,
+        # until the queue's redrive policy moves it to the dead letter queue.
+        print("Something went wrong processing message {0}: {1!r}".format(message['MessageId'], e))
+        return False
+    finally:
+        done.set()
+
+    # Delete received message from queue
+    if delete:
+        get_sqs().delete_message(
+            QueueUrl=queue_url,
+            ReceiptHandle=receipt_handle
+        )
+    # print('Received and deleted message: %s' % message)
+    return True
+
+# processors of the asset formats in AVAIAssetTypes, registered with @processes, by MIME type. A message is
+# dispatched with one lookup of its MIME type.
+processors = {}
+
+class Processor:
+    # runs the function for the messages of one kind of asset, at most concurrency at a time across the workers,
+    # and skips assets over maxBytes, which the AI service would reject or which would cost more than allowed.
+    def __init__(self, name, function, maxBytes, concurrency):
+        self.name = name
+        self.function = function
+        self.maxBytes = maxBytes
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def __call__(self, messageBody):
+        size = messageBody.get('size')
+        if size is not None and size > self.maxBytes:
+            print('Skipping {0}/{1}, {2} bytes is over the {3} limit of {4} bytes.'.format(
+                messageBody['bucketName'], messageBody['keyName'], size, self.name, self.maxBytes))
+            metrics.count(self.name + '.Skipped')
+            return
+        with self.slots:
+            self.function(messageBody)
+
+def processes(name, concurrency=workers):
+    # registers the decorated function as the processor of the MIME types AVAIAssetTypes gives to name.
+    # <NAME>_MAX_BYTES and <NAME>_CONCURRENCY override the limits.
+    def register(function):
+        processor = Processor(name, function,
+                              int(os.environ.get(name.upper() + '_MAX_BYTES', processorMaxBytes[name])),
+                              int(os.environ.get(name.upper() + '_CONCURRENCY', concurrency)))
+        for mimeType in processor_types(name):
+            processors[mimeType] = processor
+        return function
+    return register
+
+def message_mime_type(messageBody):
+    mimeType = messageBody.get('mimeType')
+    if mimeType is None:
+        mimeType = extensionTypes.get(messageBody['keyName'].rpartition('.')[2].lower())
+    return mimeType
+
+def process_message(messageBody):
+    processor = processors.get(message_mime_type(messageBody))
+    if processor is None:
+        print('No processor for {0}/{1}.'.format(messageBody['bucketName'], messageBody['keyName']))
+        metrics.count('Unsupported')
+        return
+    processor(messageBody)
+
+@processes('text')
+def process_text(messageBody):
+    print("Processing Document: {0}/{1}".format(messageBody['bucketName'], messageBody['keyName']))
+    #get the S3 object
+    fileText = get_s3().get_object(Bucket=messageBody['bucketName'], Key=messageBody['keyName'])['Body'].read().decode("utf-8", 'ignore')
+    # Process the text document.
+    process_document(messageBody['bucketName'], messageBody['keyName'], fileText, 'Text-file')
+
+@processes('audio')
+@metrics.timed('StartAudio')
 def process_audio(messageBody):
     if messageBody is not None:
         
@@ -115,18 +594,31 @@ def process_audio(messageBody):
         # call start_transcription_job
         print('Calling start_transcription_job')
 
-        mediaFormat = keyName[keyName.rindex('.')+1:len(keyName)]
+        mediaFormat = assetTypes[message_mime_type(messageBody)]['mediaFormat']
         transcriptionJobName = str(uuid.uuid4())
+        if asyncJobs:
+            # the job is finished by job_completion_handler on the Transcribe job state change event. The job is
+            # recorded before it is started, so the record is there however soon the job completes.
+            pendingJobStore.put_job(transcriptionJobName, {'JobType': 'TRANSCRIBE', 'BucketName': bucketName, 'KeyName': keyName})
         # start a async batch job for transcription
-        response = transcribe.start_transcription_job(
-                    TranscriptionJobName = transcriptionJobName,
-                    LanguageCode = 'en-US',
-                    MediaFormat = mediaFormat,
-                    Media={
-                                'MediaFileUri': 's3://{0}/{1}'.format(bucketName,keyName)
-                            },
-                    OutputBucketName = bucketName
-                    )
+        try:
+            response = transcribe.start_transcription_job(
+                        TranscriptionJobName = transcriptionJobName,
+                        LanguageCode = 'en-US',
+                        MediaFormat = mediaFormat,
+                        Media={
+                                    'MediaFileUri': 's3://{0}/{1}'.format(bucketName,keyName)
+                                },
+                        OutputBucketName = bucketName
+                        )
+        except Exception:
+            if asyncJobs:
+                pendingJobStore.delete_job(transcriptionJobName)
+            raise
+
+        if asyncJobs:
+            print('Transcription job {0} started.'.format(transcriptionJobName))
+            return
 
         transcribeResponse = None
         # Check the response in a loop to see if the job is done.
@@ -141,35 +633,42 @@ def process_audio(messageBody):
                 break
             time.sleep(3)
 
-        # we have a status
-        if transcribeResponse is not None:
-            if transcribeResponse['TranscriptionJob']['TranscriptionJobStatus'] == 'COMPLETED':
-                print('Success')
-                # extract the KeyName from the TranscriptFileUri
-                s3location = transcribeResponse['TranscriptionJob']['Transcript']['TranscriptFileUri']
-                s3location = s3location.replace('https://s3.amazonaws.com/','')
-                print ('Text extracted from audio. Proceeding to extract clinical entities from the text...')
-                targetKeyName = s3location[s3location.index('/') + 1: len(s3location)]
-                fileText = bucket.Object(targetKeyName).get()['Body'].read().decode("utf-8", 'ignore')
-                # delete the transcribe output
-                print ('Deleting transcribe output')
-                #get the S3 object
-                bucket = s3.Bucket(bucketName)
-                bucket.Object(targetKeyName).delete()
-
-                # Use the extracted file text and process it using Comprehend Medical
-                process_document(bucketName, keyName, fileText, 'Audio-file')
-            else:
-                print('Failure')
+        finish_audio(bucketName, keyName, transcribeResponse)
+
+@metrics.timed('FinishAudio')
+def finish_audio(bucketName, keyName, transcribeResponse):
+    # we have a status
+    if transcribeResponse is not None:
+        if transcribeResponse['TranscriptionJob']['TranscriptionJobStatus'] == 'COMPLETED':
+            print('Success')
+            # extract the KeyName from the TranscriptFileUri
+            s3location = transcribeResponse['TranscriptionJob']['Transcript']['TranscriptFileUri']
+            s3location = s3location.replace('https://s3.amazonaws.com/','')
+            print ('Text extracted from audio. Proceeding to extract clinical entities from the text...')
+            targetKeyName = s3location[s3location.index('/') + 1: len(s3location)]
+            #get the S3 object
+            fileText = get_s3().get_object(Bucket=bucketName, Key=targetKeyName)['Body'].read().decode("utf-8", 'ignore')
+            # delete the transcribe output
+            print ('Deleting transcribe output')
+            get_s3().delete_object(Bucket=bucketName, Key=targetKeyName)
+
+            # Use the extracted file text and process it using Comprehend Medical
+            process_document(bucketName, keyName, fileText, 'Audio-file')
         else:
             print('Failure')
+    else:
+        print('Failure')
 
 
+# scanned documents, PDF and TIFF, go to Textract.
+@processes('document')
+@metrics.timed('StartPdf')
 def process_pdf(messageBody):
     if messageBody is not None:
         
         bucketName = messageBody['bucketName']
         keyName = unquote_plus(messageBody['keyName'])
+        assetType = 'TIFF-file' if message_mime_type(messageBody) == 'image/tiff' else 'PDF-file'
         
         print("Processing document: {0}/{1}".format(bucketName, keyName))
         
@@ -177,13 +676,26 @@ def process_pdf(messageBody):
         print('Calling detect_document_text')
         
         # start an async batch job to extract text from PDF
+        # with ASYNC_JOBS enabled, Textract publishes the job status to the SNS topic, which triggers job_completion_handler.
+        jobArgs = {}
+        if asyncJobs:
+            jobArgs['NotificationChannel'] = {
+                            'SNSTopicArn': textractTopicArn,
+                            'RoleArn': textractRoleArn
+                        }
         response = textract.start_document_text_detection(
                     DocumentLocation={
                         'S3Object': {
                             'Bucket': bucketName,
                             'Name': keyName
                         }
-                    })
+                    },
+                    **jobArgs)
+
+        if asyncJobs:
+            pendingJobStore.put_job(response['JobId'], {'JobType': 'TEXTRACT', 'BucketName': messageBody['bucketName'], 'KeyName': messageBody['keyName'], 'AssetType': assetType})
+            print('Text detection job {0} started.'.format(response['JobId']))
+            return
 
         textractResponse = None
         # Check the response in a loop to see if the job is done.
@@ -198,97 +710,323 @@ def process_pdf(messageBody):
                 break
             time.sleep(2)
         
-        if textractResponse is not None:
-            if textractResponse['JobStatus'] == 'SUCCEEDED':
-                print('Success')
-                textract_output = ''
-                # contactanate all the text blocks
-                for Blocks in textractResponse["Blocks"]:
-                    if Blocks['BlockType']=='LINE':
-                        line = Blocks['Text']
-                        textract_output = textract_output + line +'\n'
-                print ('Text extracted from image. Proceeding to extract clinical entities from the text...')
-
-                # Use the extracted file text and process it using Comprehend Medical
-                process_document(messageBody['bucketName'], messageBody['keyName'],textract_output, 'PDF-file')
-            else:
-                print('Failure')
+        finish_pdf(messageBody['bucketName'], messageBody['keyName'], response['JobId'], textractResponse, assetType)
+
+def read_text_lines(jobId, textractResponse):
+    # yields (page number, text) for every LINE block of a finished text detection job, one result page at a time.
+    # textractResponse is the first page of results, the following pages are fetched using NextToken
+    # so documents with more than 1000 blocks are read completely.
+    while True:
+        for block in textractResponse['Blocks']:
+            if block['BlockType'] == 'LINE':
+                yield block.get('Page', 1), block['Text']
+        nextToken = textractResponse.get('NextToken')
+        if not nextToken:
+            return
+        print('Calling get_document_text_detection for the next page of results...')
+        textractResponse = textract.get_document_text_detection(
+                        JobId=jobId,
+                        MaxResults=1000,
+                        NextToken=nextToken
+                    )
+
+@metrics.timed('FinishPdf')
+def finish_pdf(bucketName, keyName, jobId, textractResponse, assetType='PDF-file'):
+    if textractResponse is not None:
+        if textractResponse['JobStatus'] == 'SUCCEEDED':
+            print('Success')
+            # contactanate all the text blocks
+            lines = []
+            pages = 0
+            for page, line in read_text_lines(jobId, textractResponse):
+                lines.append(line)
+                pages = max(pages, page)
+            textract_output = '\n'.join(lines) + '\n' if lines else ''
+            print ('Text extracted from {0} pages. Proceeding to extract clinical entities from the text...'.format(pages))
+
+            # Use the extracted file text and process it using Comprehend Medical
+            process_document(bucketName, keyName, textract_output, assetType)
         else:
             print('Failure')
-                
-        
+    else:
+        print('Failure')
 
-        
+@metrics.invocation
+def job_completion_handler(event, context):
+    # second phase of the Textract and Transcribe jobs started with ASYNC_JOBS enabled.
+    # accepts the SNS notification Textract sends when a text detection job is done
+    # https://docs.aws.amazon.com/textract/latest/dg/api-async.html
+    # and the EventBridge event Transcribe sends when a transcription job changes state
+    # https://docs.aws.amazon.com/transcribe/latest/dg/monitoring-events.html
+    # an exception is raised when processing fails, so the invocation is retried and the pending job is kept.
+    # an event that still fails after the retries goes to the function's dead letter queue, and its pending job
+    # is finished by the scheduled sweep, which is invoked with an EventBridge scheduled event.
+    if event.get('source') == 'aws.events':
+        sweep_pending_jobs()
+        return
+
+    completions = []
+    if 'Records' in event:
+        for record in event['Records']:
+            notification = json.loads(record['Sns']['Message'])
+            completions.append(('TEXTRACT', notification['JobId']))
+    elif event.get('source') == 'aws.transcribe':
+        completions.append(('TRANSCRIBE', event['detail']['TranscriptionJobName']))
+
+    for jobType, jobId in completions:
+        job = pendingJobStore.get_job(jobId)
+        if job is None:
+            if jobType == 'TEXTRACT':
+                # the topic only carries the jobs started here, the job may have completed before it was recorded.
+                raise Exception('No pending job found for {0} yet.'.format(jobId))
+            # transcription jobs are recorded before they are started, the rule also matches the jobs of others.
+            print('No pending job found for {0}, skipping.'.format(jobId))
+            continue
+        complete_job(jobId, job)
+
+def complete_job(jobId, job):
+    # finishes a pending job and removes its record, returns False if the job is still running.
+    print('Completing {0} job {1} for {2}/{3}'.format(job['JobType'], jobId, job['BucketName'], job['KeyName']))
+    if job['JobType'] == 'TEXTRACT':
+        textractResponse = textract.get_document_text_detection(
+                        JobId=jobId,
+                        MaxResults=1000
+                    )
+        if textractResponse['JobStatus'] == 'IN_PROGRESS':
+            return False
+        finish_pdf(job['BucketName'], job['KeyName'], jobId, textractResponse, job.get('AssetType', 'PDF-file'))
+    else:
+        transcribeResponse = transcribe.get_transcription_job(
+                            TranscriptionJobName=jobId
+                    )
+        if transcribeResponse['TranscriptionJob']['TranscriptionJobStatus'] in ('IN_PROGRESS', 'QUEUED'):
+            return False
+        finish_audio(job['BucketName'], job['KeyName'], transcribeResponse)
+
+    pendingJobStore.delete_job(jobId)
+    return True
+
+def sweep_pending_jobs():
+    # finish the jobs that are still pending long after they were started.
+    finished = running = failed = 0
+    for jobId, job in pendingJobStore.list_jobs(time.time() - jobSweepAge):
+        try:
+            if complete_job(jobId, job):
+                finished += 1
+            else:
+                running += 1
+        except Exception as e:
+            print('Could not complete job {0}: {1!r}'.format(jobId, e))
+            failed += 1
+    print('Swept pending jobs: {0} finished, {1} still running, {2} failed.'.format(finished, running, failed))
+    metrics.count('SweptJobs', finished)
+    metrics.count('SweepFailures', failed)
+
+def find_chunk_end(text, start, maxBytes):
+    # returns the end of the longest piece of text from start that fits in maxBytes,
+    # moved back to the last line, sentence or word boundary in the second half of the piece.
+    end = min(len(text), start + maxBytes)
+    size = len(text[start:end].encode('utf-8'))
+    while size > maxBytes:
+        end -= max(1, (size - maxBytes) // 4)
+        size = len(text[start:end].encode('utf-8'))
+    if end >= len(text):
+        return len(text)
+    lowest = start + (end - start) // 2
+    for separator in ['\n', '. ', ' ']:
+        index = text.rfind(separator, lowest, end)
+        if index >= 0:
+            return index + len(separator)
+    return end
+
+def chunk_text(text, maxBytes, overlap):
+    # split text into (offset, chunk) pieces of at most maxBytes, breaking on line and sentence boundaries.
+    # every chunk starts up to `overlap` characters before the end of the previous one, on a word boundary,
+    # so an entity split by a chunk boundary is still seen whole in the next chunk.
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = find_chunk_end(text, start, maxBytes)
+        chunks.append((start, text[start:end]))
+        if end >= len(text):
+            break
+        nextStart = text.rfind(' ', max(start + 1, end - overlap), end)
+        start = nextStart + 1 if nextStart >= 0 else end
+    return chunks
+
+def detect_entities_chunk(offset, chunk):
+    def call():
+        return hera.detect_entities(Text = chunk)
+    textKey = hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+    entities = cached_call('detect_entities:' + textKey, call)['Entities']
+    # move the entity offsets from the chunk to the whole document.
+    for entity in entities:
+        entity['BeginOffset'] += offset
+        entity['EndOffset'] += offset
+        for attribute in entity.get('Attributes', []):
+            if 'BeginOffset' in attribute:
+                attribute['BeginOffset'] += offset
+                attribute['EndOffset'] += offset
+    return entities
+
+def detect_entities(fileText):
+    # detect the entities of the whole text, chunk by chunk in parallel.
+    chunks = chunk_text(fileText, chunkBytes, chunkOverlap)
+    print('Calling detect_entities on {0} chunks'.format(len(chunks)))
+    with ThreadPoolExecutor(max_workers=chunkWorkers) as executor:
+        results = list(executor.map(lambda chunk: detect_entities_chunk(*chunk), chunks))
+
+    # entities found in the overlap of two chunks are reported twice, keep the one with the highest score.
+    entities = {}
+    for chunkEntities in results:
+        for entity in chunkEntities:
+            key = (entity['BeginOffset'], entity['EndOffset'], entity['Type'])
+            if key not in entities or entities[key]['Score'] < entity['Score']:
+                entities[key] = entity
+    return sorted(entities.values(), key=lambda entity: entity['BeginOffset'])
+
+class TagRecord:
+    # one tag of an asset, the fields shared by all tags of the asset are kept once by TagRecordBuilder.
+    __slots__ = ('rowId', 'operation', 'tag', 'confidence', 'value', 'faceId', 'attributes')
+
+    def __init__(self, rowId, operation, tag, confidence, value, faceId, attributes):
+        self.rowId = rowId
+        self.operation = operation
+        self.tag = tag
+        self.confidence = confidence
+        self.value = value
+        self.faceId = faceId
+        self.attributes = attributes
+
+
+class TagRecordBuilder:
+    # collects the tags found in one asset and writes them to the DynamoDB table.
+    # row ids are a hash of the location, operation, tag and face (and the occurrence of the same tag),
+    # so processing an asset again produces the same rows and overwrites them instead of adding new ones.
+    # confidence scores are stored with two decimal places instead of the ~50 digits of decimal.Decimal(float).
+    def __init__(self, bucketName, keyName, assetType, timestamp):
+        self.location = bucketName + '/' + keyName
+        self.assetType = assetType
+        self.timestamp = timestamp
+        self.records = []
+        self.occurrences = {}
+
+    def add(self, operation, tag, confidence, value=None, faceId=None, attributes=None):
+        key = '{0}\x1f{1}\x1f{2}\x1f{3}'.format(self.location, operation, tag, '' if faceId is None else faceId)
+        occurrence = self.occurrences.get(key, 0)
+        self.occurrences[key] = occurrence + 1
+        if occurrence:
+            key = '{0}\x1f{1}'.format(key, occurrence)
+        record = TagRecord(hashlib.blake2b(key.encode(), digest_size=16).hexdigest(), operation, tag,
+                           decimal.Decimal(format(confidence, '.2f')), value, faceId, attributes)
+        self.records.append(record)
+        return record
+
+    def to_item(self, record):
+        item = {
+            'ROWID': record.rowId,
+            'Location': self.location,
+            'AssetType': self.assetType,
+            'Operation': record.operation,
+            'Tag': record.tag,
+            'Confidence': record.confidence,
+            'TimeStamp': self.timestamp
+        }
+        if record.faceId is not None:
+            item['Face_Id'] = record.faceId
+        if record.value is not None:
+            item['Value'] = record.value
+        if record.attributes is not None:
+            item.update(record.attributes)
+        return item
+
+    def previous_rows(self):
+        # rows of this location written by earlier runs, by row id.
+        rows = {}
+        # Location is a DynamoDB reserved word.
+        kwargs = {'TableName': ddb_table, 'IndexName': locationIndex, 'KeyConditionExpression': '#location = :location',
+                  'ExpressionAttributeNames': {'#location': 'Location'},
+                  'ExpressionAttributeValues': to_attributes({':location': self.location})}
+        while True:
+            response = get_dynamodb().query(**kwargs)
+            for item in map(from_attributes, response['Items']):
+                rows[item['ROWID']] = item
+            if 'LastEvaluatedKey' not in response:
+                return rows
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def write(self):
+        previous = self.previous_rows() if locationIndex else {}
+        written = 0
+        requests = []
+        for record in self.records:
+            item = self.to_item(record)
+            # a row that is already stored with the same values is left as is, attributes that are not
+            # projected into the index count as changed so the row is written again.
+            old = previous.pop(record.rowId, None)
+            if old is not None and all(old.get(k) == v for (k, v) in item.items() if k != 'TimeStamp'):
+                continue
+            requests.append({'PutRequest': {'Item': to_attributes(item)}})
+            written += 1
+        for rowId in previous:
+            requests.append({'DeleteRequest': {'Key': to_attributes({'ROWID': rowId})}})
+        # batch writes for dyanmodb are an efficient way to write multiple items.
+        batch_write(ddb_table, requests)
+        print('{0}: {1} rows written, {2} unchanged, {3} deleted.'.format(self.location, written, len(self.records) - written, len(previous)))
+
+
+@metrics.timed('ProcessText')
 def process_document(bucketName, keyName, fileText, assetType):
     if fileText != '':
         
         if assetType == '':
             assetType = 'Text-file'
 
-        # comprehend medical has a input size limit of 20,000 characters.
-        # ideally, you should break it down in chunks of 20K characters and call them in a loop
-        # For this PoC, we will just consider the first 20K characters.
-        if len(fileText) > 20000:
-            fileText = fileText[0:20000]
-
-        
         # time in milliseconds
         timestamp = int(round(time.time() * 1000))
 
-         # call detect_entities
-        print('Calling detect_entities')
-
-        # Call the detect_entities API to extract the entities
-        testresult = hera.detect_entities(Text = fileText)
-
-         # Create a list of entities
-        testentities = testresult['Entities']
+        # Call the detect_entities API to extract the entities of the whole document
+        testentities = detect_entities(fileText)
 
         Trait_List = []
         Attribute_List = []
 
-        # batch writer for dyanmodb is efficient way to write multiple items.
-        with table.batch_writer() as batch:
-            # Create a loop to iterate through the individual entities
-            for row in testentities:
-                # Remove PHI from the extracted entites
-                if row['Category'] != "PERSONAL_IDENTIFIABLE_INFORMATION":
+        tags = TagRecordBuilder(bucketName, keyName, assetType, timestamp)
+        # Create a loop to iterate through the individual entities
+        for row in testentities:
+            # Remove PHI from the extracted entites
+            if row['Category'] != "PERSONAL_IDENTIFIABLE_INFORMATION":
+                
+                # Create a loop to iterate through each key in a row 
+                for key in row:
                     
-                    # Create a loop to iterate through each key in a row 
-                    for key in row:
-                        
-                        # Create a list of traits
-                        if key == 'Traits':
-                            if len(row[key])>0:
-                                Trait_List = []
-                                for r in row[key]:
-                                    Trait_List.append(r['Name'])
-                        
-                        # Create a list of Attributes
-                        elif key == 'Attributes':
-                            Attribute_List = []
+                    # Create a list of traits
+                    if key == 'Traits':
+                        if len(row[key])>0:
+                            Trait_List = []
                             for r in row[key]:
-                                Attribute_List.append(r['Type']+':'+r['Text'])
-            
-                batch.put_item(
-                        Item={
-                            'ROWID': str(uuid.uuid4()),
-                            'Location': bucketName + '/' + keyName,
-                            'AssetType': assetType,
-                            'Operation' : 'DETECT_ENTITIES',
-                            'Tag': row['Text'],
-                            'Confidence': decimal.Decimal(row['Score']) * 100,
-                            'Detect_Entities_Type' : row['Type'],
-                            'Detect_Entities_Category' : row['Category'],
-                            'Detect_Entities_Trait_List' : str(Trait_List),
-                            'Detect_Entities_Attribute_List' : str(Attribute_List),
-                            'TimeStamp': timestamp
-                            }
-                        )
+                                Trait_List.append(r['Name'])
+                    
+                    # Create a list of Attributes
+                    elif key == 'Attributes':
+                        Attribute_List = []
+                        for r in row[key]:
+                            Attribute_List.append(r['Type']+':'+r['Text'])
+        
+            tags.add('DETECT_ENTITIES', row['Text'], row['Score'] * 100, attributes={
+                'Detect_Entities_Type' : row['Type'],
+                'Detect_Entities_Category' : row['Category'],
+                'Detect_Entities_Trait_List' : str(Trait_List),
+                'Detect_Entities_Attribute_List' : str(Attribute_List)
+            })
+        tags.write()
         print('Tags inserted in DynamoDB.')
     
 
 
+# Rekognition only reads JPEG and PNG images.
+@processes('image')
+@metrics.timed('ProcessImage')
 def process_image(messageBody):
      if messageBody is not None:
         
@@ -296,152 +1034,85 @@ def process_image(messageBody):
         timestamp = int(round(time.time() * 1000))
         print("Processing Image: {0}/{1}".format(messageBody['bucketName'], messageBody['keyName']))
         
-        # call detect_labels
-        print('Calling detect_labels')
-        response = rekognition.detect_labels(
-                            Image={
-                                'S3Object': {
-                                    'Bucket': messageBody['bucketName'],
-                                    'Name': messageBody['keyName']
-                                }
-                            }
-                        )
-                        
+        if 'imageBytes' in messageBody:
+            # small images come with their bytes, which Rekognition is given directly instead of reading the S3
+            # copy, which may still be uploading. The key is the one content_key returns for the copy, the S3
+            # ETag of an object uploaded in one part being the MD5 of its bytes.
+            imageBytes = base64.b64decode(messageBody['imageBytes'])
+            imageKey = '{0}-{1}'.format(hashlib.md5(imageBytes).hexdigest(), len(imageBytes))
+            image = {'Bytes': imageBytes}
+        else:
+            imageKey = content_key(messageBody['bucketName'], messageBody['keyName'])
+            image = {
+                'S3Object': {
+                    'Bucket': messageBody['bucketName'],
+                    'Name': messageBody['keyName']
+                }
+            }
+
+        def call_detect_labels():
+            print('Calling detect_labels')
+            return cached_call('detect_labels:' + imageKey, lambda: rekognition.detect_labels(Image=image))
+
+        def call_detect_faces():
+            print('Calling detect_faces')
+            return cached_call('detect_faces:' + imageKey, lambda: rekognition.detect_faces(Image=image, Attributes=['ALL']))
+
+        def call_detect_text():
+            print('Calling detect_text')
+            return cached_call('detect_text:' + imageKey, lambda: rekognition.detect_text(Image=image))
+
+        # the rekognition calls are independent, so they are issued together instead of one after the other.
+        # text is detected in every image, faces either speculatively next to the labels or once a person is found.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            labelsFuture = executor.submit(call_detect_labels)
+            textFuture = executor.submit(call_detect_text)
+            facesFuture = executor.submit(call_detect_faces) if faceDetection == 'speculative' else None
+            response = labelsFuture.result()
+            textResponse = textFuture.result()
+            facesResponse = facesFuture.result() if facesFuture is not None else None
+
         # create data structure and insert in DDB
-        labels = []
-        faceDetails = []
+        tags = TagRecordBuilder(messageBody['bucketName'], messageBody['keyName'], 'Image', timestamp)
         bIfPerson = False
         
-        # batch writer for dyanmodb is efficient way to write multiple items.
-        with table.batch_writer() as batch:
-            for label in response['Labels']:
-                batch.put_item(
-                    Item={
-                        'ROWID': str(uuid.uuid4()),
-                        'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                        'AssetType': 'Image',
-                        'Operation' : 'DETECT_LABEL',
-                        'Tag': label['Name'],
-                        'Confidence': decimal.Decimal(label['Confidence']),
-                        'TimeStamp': timestamp
-                        }
-                    )
-                
-                if (label['Name'] == 'Human' or label['Name'] == 'Person') and (float(label['Confidence']) > 80):
-                    bIfPerson = True
-                
+        for label in response['Labels']:
+            tags.add('DETECT_LABEL', label['Name'], label['Confidence'])
+            
+            if (label['Name'] == 'Human' or label['Name'] == 'Person') and (float(label['Confidence']) > 80):
+                bIfPerson = True
+            
+            
+        if bIfPerson: # person detected, use the faces detected alongside the labels or call detect faces now
+            response = facesResponse if facesResponse is not None else call_detect_faces()
+            index = 1
+            for faceDetail in response['FaceDetails']:
+                del faceDetail['BoundingBox']
+                del faceDetail['Landmarks']
+                del faceDetail['Pose']
+                del faceDetail['Quality']
+                faceDetailConfidence = faceDetail['Confidence']
+                del faceDetail['Confidence']
                 
-            if bIfPerson: # person detected, call detect faces
-                # call detect_faces
-                print('Calling detect_faces')
-                response = rekognition.detect_faces(
-                            Image={
-                                'S3Object': {
-                                    'Bucket': messageBody['bucketName'],
-                                    'Name': messageBody['keyName']
-                                }
-                            },
-                            Attributes=['ALL']
-                        )
-                # print(json.dumps(response))        
-                # faceDetails = response['FaceDetails']
-                index = 1
-                for faceDetail in response['FaceDetails']:
-                    del faceDetail['BoundingBox']
-                    del faceDetail['Landmarks']
-                    del faceDetail['Pose']
-                    del faceDetail['Quality']
-                    faceDetailConfidence = faceDetail['Confidence']
-                    del faceDetail['Confidence']
+                for (k,v) in faceDetail.items():
+                    if(k == 'Emotions'):
+                        for emotion in v:
+                            tags.add('DETECT_FACE', emotion['Type'], emotion['Confidence'], faceId=index)
+                        continue
                     
-                    for (k,v) in faceDetail.items():
-                        if(k == 'Emotions'):
-                            for emotion in v:
-                                batch.put_item(
-                                    Item={
-                                        'ROWID': str(uuid.uuid4()),
-                                        'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                                        'AssetType': 'Image',
-                                        'Operation' : 'DETECT_FACE',
-                                        'Face_Id' : index,
-                                        'Tag': emotion['Type'],
-                                        # 'Value': v['Value'],
-                                        'Confidence': decimal.Decimal(emotion['Confidence']),
-                                        'TimeStamp': timestamp
-                                        }
-                                    )
-                            continue
+                    if(k == 'AgeRange'):
+                        tags.add('DETECT_FACE', k + '_Low', faceDetailConfidence, value=str(v['Low']), faceId=index)
+                        tags.add('DETECT_FACE', k + '_High', faceDetailConfidence, value=str(v['High']), faceId=index)
+                        continue
                         
-                        if(k == 'AgeRange'):
-                            batch.put_item(
-                                    Item={
-                                        'ROWID': str(uuid.uuid4()),
-                                        'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                                        'AssetType': 'Image',
-                                        'Operation' : 'DETECT_FACE',
-                                        'Face_Id' : index,
-                                        'Tag': k + '_Low',
-                                        'Value': str(v['Low']),
-                                        'Confidence': decimal.Decimal(faceDetailConfidence),
-                                        'TimeStamp': timestamp
-                                        }
-                                    )
-                            
-                            batch.put_item(
-                                    Item={
-                                        'ROWID': str(uuid.uuid4()),
-                                        'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                                        'AssetType': 'Image',
-                                        'Operation' : 'DETECT_FACE',
-                                        'Face_Id' : index,
-                                        'Tag': k + '_High',
-                                        'Value': str(v['High']),
-                                        'Confidence': decimal.Decimal(faceDetailConfidence),
-                                        'TimeStamp': timestamp
-                                        }
-                                    )
-                            continue
-                            
-                        batch.put_item(
-                                Item={
-                                    'ROWID': str(uuid.uuid4()),
-                                    'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                                    'AssetType': 'Image',
-                                    'Operation' : 'DETECT_FACE',
-                                    'Face_Id' : index,
-                                    'Tag': k,
-                                    'Value': str(v['Value']),
-                                    'Confidence': decimal.Decimal(v['Confidence']),
-                                    'TimeStamp': timestamp
-                                    }
-                                )
-                    index+=1
-      
-
-                # call detect_text
-                print('Calling detect_text')
-                response = rekognition.detect_text(
-                                    Image={
-                                        'S3Object': {
-                                            'Bucket': messageBody['bucketName'],
-                                            'Name': messageBody['keyName']
-                                        }
-                                    }
-                                )
-                # create data structure and insert in DDB
-                for text in response['TextDetections']:
-                    if text['Type'] == 'LINE': 
-                        batch.put_item(
-                            Item={
-                                'ROWID': str(uuid.uuid4()),
-                                'Location': messageBody['bucketName'] + '/' + messageBody['keyName'],
-                                'AssetType': 'Image',
-                                'Operation' : 'DETECT_TEXT',
-                                'Tag': text['DetectedText'],
-                                'Confidence': decimal.Decimal(text['Confidence']),
-                                'TimeStamp': timestamp
-                                }
-                            )
+                    tags.add('DETECT_FACE', k, v['Confidence'], value=str(v['Value']), faceId=index)
+                index+=1
+  
+
+        for text in textResponse['TextDetections']:
+            if text['Type'] == 'LINE': 
+                tags.add('DETECT_TEXT', text['DetectedText'], text['Confidence'])
         
+        tags.write()
         print('Tags inserted in DynamoDB.')
         return 1